@@ -1,11 +1,11 @@
 from ast import Call
-import copy
 import enum
 import itertools
 from typing import Any, Dict, Iterator, List, OrderedDict, Set, Tuple, Union, Callable
 
 from rl_sumo.helpers.utils import read_nema_config
 
+import numpy as np
 import sumolib
 import traci
 from traci.constants import TL_RED_YELLOW_GREEN_STATE, VAR_NAME, TL_PROGRAM
@@ -14,38 +14,7 @@ import xmltodict
 COLOR_ENUMERATE = {"s": 0, "r": 0, "y": 1, "G": 2, "g": 2}
 
 
-class _Base:
-    """
-    This base class freezes and unfreezes the data
-    """
-
-    def __init__(
-        self,
-    ):
-        # self.parent = parent
-        self.init_state = copy.deepcopy(self)
-
-    def _re_initialize(
-        self,
-    ):
-        """
-        This function "unfreeezes" the initial values that were saved in the call to freeze
-
-        Always update with a copy, otherwise the core will be ovewritten
-        """
-        self.__dict__.update(copy.deepcopy(self.init_state.__dict__))
-            # self.__dict__[name] = value
-
-    def freeze(
-        self,
-    ):
-        """
-        This is gets called later than the init state. and freezes all the values in self
-        """
-        self.init_state = copy.deepcopy(self)
-
-
-class DualRingActor(_Base):
+class DualRingActor:
     def __init__(
         self, tl_id, nema_config_xml: str, net_file_xml: str, subscription_method: bool
     ) -> None:
@@ -97,9 +66,6 @@ class DualRingActor(_Base):
         # traci         
         self._traci_c: traci = None
 
-        # freeze the initial settings
-        super().__init__()
-
     @property
     def default_state(
         self,
@@ -242,13 +208,19 @@ class DualRingActor(_Base):
 
     def re_initialize(self) -> None:
         """
-        Re-loads the default settings from the frozen instance.
+        Resets the per-episode state in place.
         Can be used for quick re-initialization in maching learning applications
 
         Returns:
             None
         """
-        return self._re_initialize()
+        self._requested_state.clear()
+        self._sumo_active_state = (0, ())
+        self._last_sumo_phase = ()
+        self.controlled = False
+        for tracker in self._time_tracker.values():
+            # keep the minimum duration, reset the last switch time
+            tracker[1] = 0
 
     def set_traci(self, traci_c: traci) -> Tuple[Callable, Tuple, int]:
         """
@@ -266,16 +238,21 @@ class DualRingActor(_Base):
             return (traci_c.trafficlight.getAllSubscriptionResults, (), TL_PROGRAM)
         return ()
 
-    def initialize_control(self, gracefully: bool) -> None:
+    def initialize_control(self, gracefully: bool, sub_res: Dict[int, Dict] = None) -> None:
         """
         This function initializes control of the traffic light. After
 
         Args:
             gracefully (bool):
+            sub_res (Dict[int, Dict], optional): the subscription results. Used instead of traci when subscribing
         """
         if gracefully:
             # wait for a barrier cross event (all light heads will be 'r' or 's')
-            current_str = self._traci_c.trafficlight.getRedYellowGreenState(self.tl_id)
+            current_str = (
+                sub_res[TL_PROGRAM][self.tl_id][TL_RED_YELLOW_GREEN_STATE]
+                if self._subscriptions and sub_res
+                else self._traci_c.trafficlight.getRedYellowGreenState(self.tl_id)
+            )
             if any(l in current_str for l in ["G", "g", "y"]):
                 return False
         # set the traffic light program id to the desired one
@@ -399,7 +376,7 @@ class DualRingActor(_Base):
         light_str = (
             sub_res[TL_PROGRAM][self.tl_id][TL_RED_YELLOW_GREEN_STATE]
             if self._subscriptions
-            else self.self._traci_c.trafficlight.getRedYellowGreenState(self.tl_id)
+            else self._traci_c.trafficlight.getRedYellowGreenState(self.tl_id)
         )
         return tuple(COLOR_ENUMERATE[light_str[self._p_string_map[s][0]]] for s in self.sumo_active_state)
 
@@ -416,6 +393,28 @@ class DualRingActor(_Base):
             for p in self.sumo_active_state
         )
 
+    def action_mask(self, sim_time: float, out: np.ndarray) -> np.ndarray:
+        """
+        Write which actions would take effect into out (1 = valid).
+        Until the active phases are past their minimum durations (from the _time_tracker), only the active state is valid
+
+        Args:
+            sim_time (float): the current simulation time
+            out (np.ndarray): an array of length action_space_length
+
+        Returns:
+            np.ndarray: out
+        """
+        if self.okay_2_switch(sim_time):
+            out.fill(1)
+            return out
+        out.fill(0)
+        for state in (self.sumo_active_state, self.default_state):
+            if state in self._action_space:
+                out[self._action_space.index(state)] = 1
+                break
+        return out
+
     def get_phase_active_time(self, p: int, current_time: float) -> float:
         return current_time - self._time_tracker[p][1]
 
@@ -459,6 +458,9 @@ class GlobalDualRingActor:
             nema_file_map, network_file, subscription_method
         )
 
+        # the concatenated per-traffic light action masks
+        self._action_mask = np.zeros(sum(self.discrete_space_shape), dtype=np.float32)
+
     def __iter__(self) -> Iterator[DualRingActor]:
         yield from self.tls
 
@@ -557,8 +559,36 @@ class GlobalDualRingActor:
             )
         return states, light_head_colors
 
-    def initialize_control(self, gracefully=False) -> bool:
+    def can_switch(self, sim_time: float) -> bool:
+        """
+        Whether at least one of the traffic lights is past the minimum time of its active phases
+
+        Args:
+            sim_time (float): the current simulation time
+
+        Returns:
+            bool
+        """
+        return any(tl.okay_2_switch(sim_time) for tl in self.tls)
+
+    def get_action_mask(self, sim_time: float) -> np.ndarray:
+        """
+        The valid actions of all the traffic lights, concatenated in the order of the MultiDiscrete action space
+
+        Args:
+            sim_time (float): the current simulation time
+
+        Returns:
+            np.ndarray: a (shared) array of 0s and 1s
+        """
+        start = 0
+        for tl in self.tls:
+            tl.action_mask(sim_time, self._action_mask[start:start + tl.action_space_length])
+            start += tl.action_space_length
+        return self._action_mask
+
+    def initialize_control(self, gracefully=False, subscription_results: Dict[int, Dict] = None) -> bool:
         for tl in self.tls:
             if not tl.controlled:
-                tl.initialize_control(gracefully)
+                tl.initialize_control(gracefully, subscription_results)
         return all(tl.controlled for tl in self.tls)
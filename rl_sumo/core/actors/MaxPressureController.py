@@ -0,0 +1,70 @@
+"""
+A non-learning max pressure controller for the dual ring traffic lights, to compare the policies against.
+
+Every traffic light switches to the phase combination (an action of its DualRingActor) with the most pressure,
+the sum of the pressure of its phases (MaxPressureGlobalObservations.get_phase_pressure).
+Only the actions that would take effect (the actor's action mask) are considered, so the minimum greens are kept.
+Based on https://doi.org/10.1016/j.trc.2013.08.014
+"""
+from typing import List
+
+import numpy as np
+
+from .DualRingActor import GlobalDualRingActor
+
+
+class MaxPressureController:
+    def __init__(self, actor: GlobalDualRingActor, observer) -> None:
+        """
+        Args:
+            actor (GlobalDualRingActor): the actor whose actions are chosen
+            observer (MaxPressureGlobalObservations): the observer of the same traffic lights
+        """
+        self._actor = actor
+
+        # the phases of the observer, in the order of get_phase_pressure
+        phase_index = {
+            (tl.name, phase.name): i for i, (tl, phase) in enumerate((tl, phase) for tl in observer for phase in tl)
+        }
+
+        # (action_num, phase_num): 1 where the phase is part of the action, in the order of the actor's action mask
+        actions = [(tl.tl_id, action) for tl in actor for action in tl.action_space]
+        self._incidence = np.zeros((len(actions), len(phase_index)), dtype=np.float64)
+        for row, (tl_id, action) in enumerate(actions):
+            for p in action:
+                self._incidence[row, phase_index[(tl_id, p)]] = 1
+
+        ends = np.cumsum(actor.discrete_space_shape).tolist()
+        self._slices = [slice(end - size, end) for size, end in zip(actor.discrete_space_shape, ends)]
+
+    def compute_actions(self, sim_time: float, phase_pressure: np.ndarray) -> List[int]:
+        """
+        The action of every traffic light. The actor needs to have read the traffic light states of the step
+        (GlobalDualRingActor.get_sumo_state), which the environment does when it observes
+
+        Args:
+            sim_time (float): the current simulation time
+            phase_pressure (np.ndarray): MaxPressureGlobalObservations.get_phase_pressure
+
+        Returns:
+            List[int]: the action indices, like TLDualRingEnv's MultiDiscrete action space
+        """
+        scores = self._incidence @ phase_pressure
+        scores[self._actor.get_action_mask(sim_time) == 0] = -np.inf
+        # ties go to the first action, the barrier states.
+        # If none of a light's actions would take effect, argmax would pick the first one, so it keeps its state instead
+        return [
+            int(np.argmax(scores[s])) if np.isfinite(scores[s]).any() else self._current_action(tl)
+            for tl, s in zip(self._actor, self._slices)
+        ]
+
+    @staticmethod
+    def _current_action(tl) -> int:
+        """
+        The action of the state that the traffic light is in (or was last asked for), the default state otherwise
+        """
+        for state in (set(tl.sumo_active_state), tl.requested_state, set(tl.default_state)):
+            for i, action in enumerate(tl.action_space):
+                if set(action) == state:
+                    return i
+        return 0
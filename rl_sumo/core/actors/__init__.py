@@ -1,2 +1,3 @@
 from .actor import *
 from .DualRingActor import *
+from .MaxPressureController import *
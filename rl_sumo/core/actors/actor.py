@@ -1,9 +1,9 @@
 import enum
 import json5 as json
-import copy
 from distutils.util import strtobool
 from typing import List
 from xml.dom import minidom
+import numpy as np
 import traci
 
 
@@ -67,43 +67,7 @@ def safe_int(prospective_int):
         return prospective_int
 
 
-class _Timer:
-    """
-    This class creates a global timer
-
-    Returns:
-        float: a copy of the current time
-    """
-    time = 0.
-
-    @staticmethod
-    def get_time():
-        return copy.copy(_Timer.time)
-
-
-class _Base:
-    """
-    This base class freezes and unfreezes the data
-    """
-    def __init__(self, ):
-        # self.parent = parent
-        self.init_state = copy.deepcopy(self.__dict__)
-
-    def _re_initialize(self, ):
-        """
-        This function "unfreeezes" the initial values that were saved in the call to freeze
-        """
-        for name, value in self.init_state.items():
-            self.__dict__[name] = value
-
-    def freeze(self, ):
-        """
-        This is gets called later than the init state. and freezes all the values in self 
-        """
-        self.init_state = copy.deepcopy(self.__dict__)
-
-
-class TrafficLightManager(_Base):
+class TrafficLightManager:
     def __init__(self, tl_id, tl_details, tl_file):
         """
         TrafficLightManager represents a controller sitting at each traffic light
@@ -121,12 +85,6 @@ class TrafficLightManager(_Base):
         self.action_space, self.action_space_index_dict = self._create_states()
         self.action_space_length = len(self.action_space)
         self.phase_num_name_eq = self.read_in_tls_xml(tl_file)
-        self._task_list = []
-        self._last_green_time = 0
-        # self._transition_active = False
-        self._sim_time = 0
-        self._last_changed_time = 0
-        self._color = 'g'
         self._minimum_times = {
             'r': 3,  # this is really the time from yellow -> red
             'y': 5,  # this is green -> yellow
@@ -134,7 +92,17 @@ class TrafficLightManager(_Base):
         }
         self._color_int = {'r': 0, 'y': 1, 'g': 2}
 
-        super().__init__()
+        # the state that every episode starts in. Never mutated, current_state is only ever re-assigned
+        self._initial_state: list = self.current_state
+
+        # the per-episode state. Set by re_initialize
+        self._task_list = []
+        self._last_green_time = 0
+        # self._transition_active = False
+        self._sim_time = 0
+        self._last_changed_time = 0
+        self._color = 'g'
+        self.re_initialize()
 
         self.traci_c = None
 
@@ -142,7 +110,15 @@ class TrafficLightManager(_Base):
         pass
 
     def re_initialize(self, ):
-        self._re_initialize()
+        """
+        Reset the per-episode state in place
+        """
+        self.current_state = self._initial_state
+        self._task_list.clear()
+        self._last_green_time = 0
+        self._sim_time = 0
+        self._last_changed_time = 0
+        self._color = 'g'
 
     def _set_initial_states(self, light_string: str):
         """
@@ -292,7 +268,7 @@ class TrafficLightManager(_Base):
         return True
 
     def _update_timer(self, *args, **kwargs):
-        self._last_green_time = _Timer.get_time()
+        self._last_green_time = self._sim_time
         return True
 
     def _step(self, ):
@@ -310,6 +286,38 @@ class TrafficLightManager(_Base):
     def _check_timer(self, color):
         return self._sim_time - self._last_changed_time >= self._minimum_times[color]
 
+    def can_switch(self, sim_time: float) -> bool:
+        """
+        Whether a new action would start a transition right now.
+        That requires no transition in progress and the light having been in its current color for the minimum time
+
+        Args:
+            sim_time (float): the current simulation time
+
+        Returns:
+            bool
+        """
+        return self.tasks_are_empty() and (sim_time - self._last_changed_time >= self._minimum_times['y'])
+
+    def action_mask(self, sim_time: float, out: np.ndarray) -> np.ndarray:
+        """
+        Write which actions would take effect into out (1 = valid).
+        While a transition is running or the minimum time hasn't passed, only staying in the current state is valid
+
+        Args:
+            sim_time (float): the current simulation time
+            out (np.ndarray): an array of length action_space_length
+
+        Returns:
+            np.ndarray: out
+        """
+        if self.can_switch(sim_time):
+            out.fill(1)
+        else:
+            out.fill(0)
+            out[self.get_current_state()] = 1
+        return out
+
     def set_light_state(self, phase_list, color):
         if self._check_timer(color):
             self._last_changed_time = self._sim_time
@@ -337,7 +345,7 @@ class TrafficLightManager(_Base):
         return self.action_space_index_dict[tuple(self.current_state)]
 
     def get_last_green_time(self, ):
-        return _Timer.time - self._last_green_time
+        return self._sim_time - self._last_green_time
 
     def get_light_head_color(self, ):
         return self._color_int[self._color]
@@ -347,6 +355,9 @@ class GlobalActor:
     def __init__(self, tl_settings_file, tl_file_dicts):
         self.tls = self.create_tl_managers(read_settings(tl_settings_file), tl_file_dicts)
 
+        # the concatenated per-traffic light action masks
+        self._action_mask = np.zeros(sum(self.discrete_space_shape), dtype=np.float32)
+
     def __iter__(self) -> TrafficLightManager:
         yield from self.tls
 
@@ -399,13 +410,34 @@ class GlobalActor:
         ]
 
     def update_lights(self, action_list: list, sim_time: float) -> None:
-        _Timer.time = sim_time
         for action, tl_manager in zip(action_list, self):
             # if action < tl_manager.action_space_length:
             tl_manager.update_state(action, sim_time)
             # tl_manager.update_sumo()
         # return {tl_id: self.tls[tl_id].update_state(action) for tl_id, action in action_dict.items()}
 
+    def can_switch(self, sim_time: float) -> bool:
+        """
+        Whether at least one of the traffic lights can accept a new phase
+
+        @param sim_time: the current simulation time
+        @return: bool
+        """
+        return any(tl_manager.can_switch(sim_time) for tl_manager in self)
+
+    def get_action_mask(self, sim_time: float) -> np.ndarray:
+        """
+        The valid actions of all the traffic lights, concatenated in the order of the MultiDiscrete action space
+
+        @param sim_time: the current simulation time
+        @return: a (shared) array of 0s and 1s
+        """
+        start = 0
+        for tl_manager in self:
+            tl_manager.action_mask(sim_time, self._action_mask[start:start + tl_manager.action_space_length])
+            start += tl_manager.action_space_length
+        return self._action_mask
+
     def get_current_state(self, ) -> List[
             int,
     ]:
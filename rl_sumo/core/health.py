@@ -0,0 +1,108 @@
+"""
+Tracks how healthy a long running SUMO process is, so that the environment only tears it down when it has to.
+
+Three things are measured:
+1. the resident memory (RSS) of the SUMO process
+2. the mean per-step latency of an episode, relative to the first episode after a (re)start
+3. the time that a soft reset (loading the saved state) takes
+"""
+import logging
+from typing import Optional
+
+# Linux reports VmRSS in kB
+_KB_2_MB = 1 / 1024
+
+
+def read_rss_mb(pid: int) -> Optional[float]:
+    """
+    Read the resident memory of a process from /proc
+
+    Args:
+        pid (int): the process id
+
+    Returns:
+        Optional[float]: the RSS in MB. None if it can't be read (not Linux or the process is gone)
+    """
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return float(line.split()[1]) * _KB_2_MB
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class SumoHealth:
+    """
+    Collects the health metrics and decides when SUMO should be restarted
+    """
+
+    def __init__(self, max_rss_mb: float = None, max_latency_drift: float = None, max_soft_reset_time: float = None):
+        """
+        Any threshold that is None is not checked
+
+        Args:
+            max_rss_mb (float, optional): restart when SUMO's RSS (in MB) is above this
+            max_latency_drift (float, optional): restart when an episode's mean step latency is this many times
+                the mean step latency of the first episode after the last restart
+            max_soft_reset_time (float, optional): restart when a soft reset takes longer than this (in seconds)
+        """
+        self.max_rss_mb = max_rss_mb
+        self.max_latency_drift = max_latency_drift
+        self.max_soft_reset_time = max_soft_reset_time
+
+        self.restarted()
+
+    def restarted(self, ) -> None:
+        """
+        Called after SUMO has been (re)started. The latency baseline is re-measured on the next episode
+        """
+        self.baseline_latency: float = None
+        self.latency_drift: float = 1.
+        self.soft_reset_time: float = 0.
+        self._step_time = 0.
+        self._step_num = 0
+
+    def record_step(self, seconds: float) -> None:
+        self._step_time += seconds
+        self._step_num += 1
+
+    def record_soft_reset(self, seconds: float) -> None:
+        self.soft_reset_time = seconds
+
+    def end_episode(self, ) -> None:
+        """
+        Close out the step latency of the episode that just ended
+        """
+        if not self._step_num:
+            return
+        mean_latency = self._step_time / self._step_num
+        if self.baseline_latency is None:
+            self.baseline_latency = mean_latency
+        else:
+            self.latency_drift = mean_latency / self.baseline_latency
+        self._step_time = 0.
+        self._step_num = 0
+
+    def restart_reason(self, pid: int) -> Optional[str]:
+        """
+        Check the metrics against the thresholds
+
+        Args:
+            pid (int): SUMO's process id
+
+        Returns:
+            Optional[str]: why SUMO should be restarted, or None if it is healthy
+        """
+        reason = None
+        if self.max_soft_reset_time is not None and self.soft_reset_time > self.max_soft_reset_time:
+            reason = f"soft reset took {self.soft_reset_time:.2f} s"
+        elif self.max_latency_drift is not None and self.latency_drift > self.max_latency_drift:
+            reason = f"step latency drifted {self.latency_drift:.2f}x"
+        elif self.max_rss_mb is not None and (rss := read_rss_mb(pid)) is not None and rss > self.max_rss_mb:
+            reason = f"SUMO is using {rss:.0f} MB"
+
+        if reason:
+            logging.info(f"restarting SUMO: {reason}")
+        return reason
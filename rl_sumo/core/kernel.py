@@ -1,10 +1,12 @@
 import contextlib
 import os
 import signal
+import uuid
 import traci
 import traci.constants as tc
 import logging
 from copy import deepcopy
+from typing import List
 from sumolib import checkBinary
 
 # should I try and use libsumo?
@@ -43,6 +45,9 @@ def sumo_cmd_line(params, kernel):
     if params.gui:
         cmd.extend(["--start"])
 
+    if kernel.demand_scale != 1:
+        cmd.extend(["--scale", str(kernel.demand_scale)])
+
     if params["emissions"]:
         cmd.extend(["--emission-output", params["emissions"]])
 
@@ -52,13 +57,16 @@ def sumo_cmd_line(params, kernel):
 VEHICLE_SUBSCRIPTIONS = [tc.VAR_POSITION, tc.VAR_FUELCONSUMPTION, tc.VAR_SPEED]
 
 
+def _copy_result(result):
+    # the per-object dictionaries are replaced (not cleared) by traci, so a shallow copy is enough
+    return dict(result) if isinstance(result, dict) else result
+
+
 class Kernel(object):
     """
     This class is the core for interfacing with the simulation
     """
 
-    CONNECTION_NUMBER = 0
-
     def __init__(self, sim_params):
 
         self.traci_c = None
@@ -66,23 +74,56 @@ class Kernel(object):
         self.parent_fns = []
         self.sim_params = deepcopy(sim_params)
         self.sim_step_size = self.sim_params.sim_step
-        self.state_file = os.path.join(
-            sim_params.sim_state_dir, f"start_state_{sim_params.port}.xml"
-        )
         self.sim_time = 0
         self.seed = 5
         self.traci_calls = []
         self.sim_data = {}
 
+        # traci clears the subscription results in place on every step.
+        # If the results are read while the next step runs (on another thread), they need to be copied
+        self.copy_results = False
+
+        # the variables that every vehicle is subscribed to. The environment narrows them down to what the observer and
+        # the rewarder use. Nothing is subscribed per vehicle if it is empty
+        self.vehicle_subscriptions: List[int] = list(VEHICLE_SUBSCRIPTIONS)
+
         self._initial_tl_colors = {}
 
-        self._sumo_conn_label = str(Kernel.CONNECTION_NUMBER)
-        # increment the connection
-        Kernel.CONNECTION_NUMBER += 1
+        # the factor that the route demand is scaled by (SUMO's --scale) and the scales that have a saved warm state
+        self.demand_scale: float = 1.
+        self._warm_scales = set()
+
+        # whether the kernel switches the traffic lights to the RL program ("<tl_id>-2").
+        # Actors that bring their own program (like the DualRingActor) turn this off
+        self.rl_program_control = True
+
+        # a label that is unique to this kernel, so that many kernels can live in one process
+        self._sumo_conn_label = uuid.uuid4().hex
 
     def set_seed(self, seed):
         self.seed = seed
 
+    @property
+    def state_file(self, ) -> str:
+        """
+        The saved warm state. Every demand scale has its own
+        """
+        suffix = "" if self.demand_scale == 1 else f"_scale_{self.demand_scale}"
+        return os.path.join(self.sim_params.sim_state_dir, f"start_state_{self.sim_params.port}{suffix}.xml")
+
+    def set_demand_scale(self, scale: float) -> bool:
+        """
+        Set the demand scale for the next reset
+
+        Args:
+            scale (float): the factor to scale the route demand by
+
+        Returns:
+            bool: whether there is already a warm state for this scale (otherwise SUMO has to be started and warmed up)
+        """
+        self.demand_scale = scale
+        return scale in self._warm_scales
+
     def pass_traci_kernel(self, traci_c):
         """
         This is the method that FLOW uses. Causes traci to "live" at the parent level
@@ -91,7 +132,15 @@ class Kernel(object):
         """
         self.traci_c = traci_c
 
-    def start_simulation(
+    @property
+    def sumo_pid(self, ) -> int:
+        """
+        The process id of SUMO. With libsumo, SUMO runs inside of this process
+        """
+        process = getattr(self.traci_c, "_process", None)
+        return process.pid if process is not None else os.getpid()
+
+    def _launch_sumo(
         self,
     ):
         # find SUMO
@@ -120,6 +169,28 @@ class Kernel(object):
         # connect to traci
         traci_c.simulationStep()
 
+        return traci_c
+
+    def start_simulation(
+        self,
+        from_snapshot: bool = False,
+    ):
+        """
+        Start SUMO, warm it up and save the state that every episode starts from
+
+        Args:
+            from_snapshot (bool, optional): if the state was already saved, load it instead of warming up again.
+                Defaults to False.
+        """
+        traci_c = self._launch_sumo()
+
+        if from_snapshot and os.path.exists(self.state_file):
+            # restarting a SUMO that went bad. This is the same as a soft reset on the fresh process
+            self.traci_c = traci_c
+            self.reset_simulation()
+            self._add_simulation_calls(traci_c)
+            return traci_c
+
         # set the traffic lights to the default behaviour and run for warm up period
         for tl_id in self.sim_params.tl_ids:
             traci_c.trafficlight.setProgram(tl_id, f"{tl_id}-1")
@@ -129,15 +200,16 @@ class Kernel(object):
             traci_c.simulationStep()
 
         # subscribe to all the vehicles in the network at this state
-        for veh_id in traci_c.vehicle.getIDList():
-            traci_c.vehicle.subscribe(veh_id, VEHICLE_SUBSCRIPTIONS)
+        if self.vehicle_subscriptions:
+            for veh_id in traci_c.vehicle.getIDList():
+                traci_c.vehicle.subscribe(veh_id, self.vehicle_subscriptions)
 
         # get the light states
         # for tl_id in self.sim_params.tl_ids:
         #     self._initial_tl_colors[tl_id] = traci_c.trafficlight.getRedYellowGreenState(tl_id)
 
         # set the traffic lights to the all green program
-        if not self.sim_params.no_actor:
+        if not self.sim_params.no_actor and self.rl_program_control:
             for tl_id in self.sim_params.tl_ids:
                 traci_c.trafficlight.setProgram(tl_id, f"{tl_id}-2")
 
@@ -147,9 +219,17 @@ class Kernel(object):
 
         # saving the beginning state of the simulation
         traci_c.simulation.saveState(self.state_file)
+        self._warm_scales.add(self.demand_scale)
+
+        self._subscribe_to_simulation(traci_c)
 
-        traci_c.simulation.subscribe([tc.VAR_COLLIDING_VEHICLES_NUMBER])
+        self._add_simulation_calls(traci_c)
 
+        self.sim_time = 0
+
+        return traci_c
+
+    def _add_simulation_calls(self, traci_c):
         self.add_traci_call(
             [
                 [
@@ -160,17 +240,20 @@ class Kernel(object):
             ]
         )
 
-        self.sim_time = 0
-
-        return traci_c
+    @staticmethod
+    def _subscribe_to_simulation(traci_c):
+        # the departed vehicles come with the step results, rather than an extra call every step
+        traci_c.simulation.subscribe([tc.VAR_COLLIDING_VEHICLES_NUMBER, tc.VAR_DEPARTED_VEHICLES_IDS])
 
     # @staticmethod
     def _subscribe_to_vehicles(
         self,
     ):
         # subscribe to all new vehicle positions and fuel consumption
-        for veh_id in self.traci_c.simulation.getDepartedIDList():
-            self.traci_c.vehicle.subscribe(veh_id, VEHICLE_SUBSCRIPTIONS)
+        if not self.vehicle_subscriptions:
+            return
+        for veh_id in self.traci_c.simulation.getSubscriptionResults().get(tc.VAR_DEPARTED_VEHICLES_IDS, ()):
+            self.traci_c.vehicle.subscribe(veh_id, self.vehicle_subscriptions)
 
     def reset_simulation(
         self,
@@ -183,16 +266,23 @@ class Kernel(object):
             # self.traci_c.load(sumo_cmd_line(self.sim_params))
             with contextlib.suppress(AttributeError):
                 self.traci_c.simulation.clearPending()
-            # unsubscribe from all the vehicles at the end state
-            for veh_id in self.traci_c.vehicle.getIDList():
+            # unsubscribe from all the (subscribed) vehicles at the end state.
+            # A freshly started SUMO has vehicles that were never subscribed to
+            for veh_id in list(self.traci_c.vehicle.getAllSubscriptionResults()):
                 self.traci_c.vehicle.unsubscribe(veh_id)
 
             logging.info("resetting the simulation")
             self.traci_c.simulation.loadState(self.state_file)
 
+            # loading the state drops the simulation subscription
+            self._subscribe_to_simulation(self.traci_c)
+
+            # the process might have been started with another demand scale
+            self.traci_c.simulation.setScale(self.demand_scale)
+
             # set the traffic lights to the correct program
             # set the traffic lights to the all green program
-            if not self.sim_params.no_actor:
+            if not self.sim_params.no_actor and self.rl_program_control:
 
                 for tl_id in self.sim_params.tl_ids:
                     self.traci_c.trafficlight.setProgram(tl_id, f"{tl_id}-2")
@@ -204,8 +294,9 @@ class Kernel(object):
 
             # subscribe to all of the vehicles again
             # unsubscribe from all the vehicles at the end state
-            for veh_id in self.traci_c.vehicle.getIDList():
-                self.traci_c.vehicle.subscribe(veh_id, VEHICLE_SUBSCRIPTIONS)
+            if self.vehicle_subscriptions:
+                for veh_id in self.traci_c.vehicle.getIDList():
+                    self.traci_c.vehicle.subscribe(veh_id, self.vehicle_subscriptions)
 
         except Exception as e:
             print("Something in TRACI failed")
@@ -273,6 +364,8 @@ class Kernel(object):
     def get_traci_data(
         self,
     ):
+        if self.copy_results:
+            return {key: _copy_result(fn(*args)) for fn, args, key in self.traci_calls}
         return {key: fn(*args) for fn, args, key in self.traci_calls}
 
     def add_traci_call(self, traci_module):
@@ -10,8 +10,10 @@ from cmath import phase
 import math
 from typing import Dict, Iterable, List, OrderedDict, Tuple, Union
 from enum import Enum
+import numpy as np
 import sumolib
 from traci.constants import (
+    CMD_GET_LANEAREA_VARIABLE,
     LAST_STEP_VEHICLE_ID_LIST,
     VAR_VEHICLE,
     VAR_LANES,
@@ -20,7 +22,7 @@ from traci.constants import (
 from copy import deepcopy
 
 from ...helpers.utils import read_nema_config
-from .observer import Lane, LaneType, xy_to_m
+from .observer import VEHICLE_MODE, Lane, LaneType
 from .per_phase_observer import GlobalPhaseObservations, Phase, PhaseTLObservations
 
 DISTANCE_THRESHOLD = 100  # in meters
@@ -37,6 +39,9 @@ class MaxPressureLane(Lane):
     It can be extended in the future
     """
 
+    # the density in lanearea mode, otherwise it is read from the engine
+    _density: float = 0
+
     def __init__(self, lane_list: List[sumolib.net.lane.Lane], direction: LaneType):
         """
         Initialising the base class
@@ -47,12 +52,6 @@ class MaxPressureLane(Lane):
         # a "lane" can actually be composed of multiple lanes in the SUMO network, aka depending on the distance backwards that we should "observe"
         self._lane_list: List[str] = [l.getID() for l in lane_list]
 
-        # the density of cars
-        self.density: int = 0
-
-        # the ids of the cars in the lane during the last time step
-        self._last_ids: List[str] = []
-
         # a storage of the direction (either incoming or outgoing)
         self._direction: LaneType = direction
 
@@ -85,38 +84,25 @@ class MaxPressureLane(Lane):
         for lane in self._lane_list:
             traci_c.lane.subscribe(lane, [LAST_STEP_VEHICLE_ID_LIST])
 
-    def update_density(
-        self, center: tuple, lane_ids: dict, vehicle_positions: dict
-    ) -> None:
+    @property
+    def density(self, ) -> float:
+        """
+        @return: the density of cars
         """
-        this function redefines the _Base update_counts and implements the logic for each lane
+        return self._density if self._engine is None else self._engine_value("density")
 
-        @param vehicle_positions: {ids: positions}
-        @param lane_ids: {lane_ids: {18: [id_list]}}
-        @param center: the center of the intersection (simulating where a camera would be placed)
-        @return: None
+    def _set_count(self, count: int) -> None:
+        super()._set_count(count)
+        self._density = (count / self._max_permissible_vehicles) * self._direction.value
+
+    def update_density(self, **kwargs) -> float:
         """
-        # call traci to get the ids of vehicles in each of the lanes
-        ids = []
-        for lane in self._lane_list:
-            ids.extend(lane_ids[lane][18])
-        # loop through the ids, only checking the distance for those that are "new" to the network
-        new_ids = []
-        if len(ids):
-            for _id in ids:
-                # if it was there last time, it will be there this timestep. Assuming that cars do not travel backwards
-                if _id in self._last_ids:
-                    new_ids.append(_id)
-
-                elif (
-                    xy_to_m(*center, *vehicle_positions[_id][VAR_POSITION])
-                    <= DISTANCE_THRESHOLD
-                ):
-                    new_ids.append(_id)
-        # assign these new ids to the history
-        self._last_ids = new_ids
-        self.density = (len(new_ids) / self._max_permissible_vehicles) * self._direction
-        return self.density
+        The density of the lane. The engine counts the lanes, only the lane-area detectors are read here
+
+        @param detector_info: {detector_ids: {variable: value}}, in lanearea mode
+        @return: the density of the lane
+        """
+        return self.update_counts(**kwargs)
 
     def get_density(
         self,
@@ -140,14 +126,14 @@ class MaxPressureLane(Lane):
         # subscribe to the lane that I am in charge of
         self._subscribe_2_lanes(traci_c)
 
-    def update_counts(self, *args, **kwargs) -> float:
+    def get_counts(self, ) -> float:
         """
-        Override super update count method to return a float
+        Override super get_counts method to return a float
 
         Returns:
             float: the density of the lane
         """
-        return self.update_density(*args, **kwargs)
+        return self.density
 
 
 class MaxPressurePhase(Phase):
@@ -228,25 +214,11 @@ class MaxPressureTLObservations(PhaseTLObservations):
     ) -> List[float]:
         return self.count_list
 
-    def update_counts(
-        self, **kwargs
-    ) -> List[List,]:
-        """
-        This function calls update_counts on the children and passes the center coordinates
-
-        @param kwargs: a forgiving list of inputs
-        @return: a list of lists
-        """
-        self.count_list.clear()
-        for child in self:
-            self.count_list.append(child.update_counts(center=self._center, **kwargs))
-        return self.count_list.copy()
-
     def get_pressure(self, mapped_method) -> Union[List[int], Dict[int, float]]:
         if mapped_method:
-            return {t.name: sum(t.count_list) for t in self._children}
+            return {t.name: sum(t.collect()) for t in self._children}
         else:
-            return self.count_list
+            return self.collect()
 
 
 class MaxPressureGlobalObservations(GlobalPhaseObservations):
@@ -254,8 +226,39 @@ class MaxPressureGlobalObservations(GlobalPhaseObservations):
     The overall observation space class
     """
 
-    def __init__(self, net_file: str, nema_file_map: Dict[str, str], name: str):
-        super().__init__(net_file, nema_file_map, name)
+    engine_features = ("density", )
+
+    # (phase_num, engine slot_num): 1 where the engine slot is a lane of the phase. Built on the first step,
+    # once the engine's slots are final
+    _incidence: np.ndarray = None
+
+    def __init__(self, net_file: str, nema_file_map: Dict[str, str], name: str, mode: str = VEHICLE_MODE,
+                 lane_positions: bool = False):
+        super().__init__(net_file, nema_file_map, name, mode, lane_positions)
+
+    def _compose_tls(
+        self, net_obj: sumolib.net.Net, nema_file_map: Dict[str, str]
+    ) -> list:
+        """
+        This function is called only once and it creates a list of MaxPressureTLObservations
+
+        @param net_obj: the sumolib.net object
+        @return: a list
+        """
+        return [
+            MaxPressureTLObservations(
+                net_obj=net_obj,
+                tl_id=tls,
+                nema_config_dict=read_nema_config(nema_file_map[tls]),
+            )
+            for tls in self._tl_ids
+        ]
+
+    def compile_topology(self, engine=None):
+        engine = super().compile_topology(engine)
+        # the slots may have moved
+        self._incidence = None
+        return engine
 
     def get_pressure(self, sim_dict) -> List[float]:
         """
@@ -263,27 +266,46 @@ class MaxPressureGlobalObservations(GlobalPhaseObservations):
 
         @return: self.count_list
         """
+        if self._engine is not None:
+            densities = self._engine_values(sim_dict, "density")
+            return [densities[s] for s in self._phase_slices]
+
         counts = []
         # print("sim_counts", sim_dict[VAR_LANES])
         for child in self.tls:
             counts.extend(
                 # update counts really updates the density
-                child.update_pressure(
-                    lane_ids=sim_dict[VAR_LANES],
-                    vehicle_positions=sim_dict[VAR_VEHICLE],
-                )
+                child.update_pressure(detector_info=sim_dict[CMD_GET_LANEAREA_VARIABLE])
             )
 
         # return the pre-constructed count dictionary
         return counts
 
+    def get_phase_pressure(self, sim_dict) -> np.ndarray:
+        """
+        The pressure of every phase of every traffic light (the sum of its lane densities), in the order of get_pressure.
+        Outside of lanearea mode it is the phase-to-lane incidence matrix times the engine's densities
+
+        @return: a (phase_num, ) array
+        """
+        if self._engine is None:
+            return np.array([sum(phase) for phase in self.get_pressure(sim_dict)], dtype=np.float64)
+
+        densities = self._engine.update(sim_dict)["density"]
+        if self._incidence is None:
+            self._incidence = np.zeros((len(self._phase_slices), len(densities)), dtype=np.float64)
+            for phase, s in enumerate(self._phase_slices):
+                # add.at, in case two of the phase's lanes share an engine slot
+                np.add.at(self._incidence[phase], self._slots[s], 1)
+        return self._incidence @ densities
+
     def get_counts(self, sim_dict) -> list:
         """
         update the counts for all lanes by passing the subscription updates
 
         @return: self.count_list
         """
-        return self.get_density(sim_dict)
+        return self.get_pressure(sim_dict)
 
     def update_counts(self, **kwargs):
         return self.get_pressure(**kwargs)
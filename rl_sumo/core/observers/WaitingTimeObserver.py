@@ -12,7 +12,7 @@ from traci.constants import (
 from copy import deepcopy
 
 from rl_sumo.helpers.utils import read_nema_config
-from .observer import DISTANCE_THRESHOLD, Lane, LaneType, xy_to_m
+from .observer import DISTANCE_THRESHOLD, VEHICLE_MODE, Lane, LaneType
 from .per_phase_observer import GlobalPhaseObservations, Phase, PhaseTLObservations
 
 
@@ -26,64 +26,23 @@ class WaitingTimeLane(Lane):
     It can be extended in the future
     """
 
+    # the lane-area detectors don't report a waiting time, it stays 0 in lanearea mode
+    _waiting_time: float = 0
+
     def __init__(self, lane_list: List[str], direction: LaneType = ..., *args, **kwargs):
         super().__init__(lane_list, direction, *args, **kwargs)
-        
-        # a store of the waiting time on each lane
-        self.waiting_time = 0
-
-    def _subscribe_2_lanes(self, traci_c):
-        """
-        This function is called once to subscribe to the lanes
 
-        @return:
+    @property
+    def waiting_time(self, ) -> float:
         """
-        for lane in self._lane_list:
-            traci_c.lane.subscribe(lane, [LAST_STEP_VEHICLE_ID_LIST, VAR_WAITING_TIME])
-
-    def update_counts(
-        self, center: tuple, lane_info: dict, vehicle_info: dict
-    ) -> Tuple[float, float]:
-        """
-        this function redefines the _Base update_counts and implements the logic for each lane
-
-        @param vehicle_positions: {ids: positions}
-        @param lane_ids: {lane_ids: {18: [id_list]}}
-        @param center: the center of the intersection (simulating where a camera would be placed)
-        @return: None
+        @return: the waiting time of the vehicles that the camera sees on the lane
         """
-        # call traci to get the ids of vehicles in each of the lanes
-        ids = []
-        for lane in self._lane_list:
-            ids.extend(lane_info[lane][18])
-        # loop through the ids, only checking the distance for those that are "new" to the network
-        new_ids = []
-        if len(ids):
-            for _id in ids:
-                # if it was there last time, it will be there this timestep. Assuming that cars do not travel backwards
-                if _id in self._last_ids:
-                    new_ids.append(_id)
-
-                elif (
-                    xy_to_m(*center, *vehicle_info[_id][VAR_POSITION])
-                    <= DISTANCE_THRESHOLD
-                ):
-                    new_ids.append(_id)
-
-        # assign the waiting time
-        # TODO make this have a distance horizon. Could use the vehicles waiting time for that.
-        # Commenting out for now
-        # self.waiting_time = sum(
-        #     lane_info[_lane][VAR_WAITING_TIME] for _lane in self._lane_list
-        # )
-
-        # assign these new ids to the history
-        self._last_ids = new_ids
-        self.count = len(new_ids)
-        return (self.count, self.waiting_time)
+        return self._waiting_time if self._engine is None else self._engine_value("waiting_time")
 
     def get_vehicle_ids(self, ) -> List[str]:
-        return self._last_ids
+        if self._engine is None:
+            return []
+        return self._engine.vehicle_ids()[self._slot]
 
     def get_counts(
         self,
@@ -136,7 +95,7 @@ class WaitingTimePhase(Phase):
     def get_waiting_time(
         self,
     ):
-        return [sum(l.waiting_time) for l in self._children]
+        return [l.waiting_time for l in self._children]
 
     def get_value(self, param: str, mapped: bool = False):
         return sum(getattr(c, param) for c in self._children)
@@ -183,7 +142,7 @@ class WaitingTimeTLObservations(PhaseTLObservations):
         if mapped_method:
             return {t.name: t.get_waiting_time() for t in self._children}
         else:
-            return (l[1] for a in self.count_list for l in a.count_list)
+            return (l[1] for phase in self.collect() for l in phase)
 
     def get_vehicle_ids(
         self, mapped_method: bool = False
@@ -196,11 +155,17 @@ class WaitingTimeTLObservations(PhaseTLObservations):
 
 class GlobalWaitingTimeObserver(GlobalPhaseObservations):
     """
-    The overall observation space class
+    The overall observation space class. Every lane observes (count, waiting time).
+    In lanearea mode the waiting time stays 0
     """
 
-    def __init__(self, net_file: str, tl_ids: list, name: str):
-        super().__init__(net_file, tl_ids, name)
+    engine_features = ("count", "waiting_time")
+    # the waiting time comes with the vehicle positions
+    vehicle_variables = (VAR_WAITING_TIME, )
+    inside_lane_variables = (VAR_WAITING_TIME, )
+
+    def __init__(self, net_file: str, tl_ids: list, name: str, mode: str = VEHICLE_MODE, lane_positions: bool = False):
+        super().__init__(net_file, tl_ids, name, mode, lane_positions)
     
     def _compose_tls(
         self, net_obj: sumolib.net.Net, nema_file_map: Dict[str, str]
@@ -221,21 +186,16 @@ class GlobalWaitingTimeObserver(GlobalPhaseObservations):
             for tls in self._tl_ids
         ]
 
-    def register_traci(self, traci_c: object) -> Tuple[Tuple[object, tuple, int]]:
+    def get_counts(self, sim_dict) -> list:
         """
-        pass traci to the children and return the functions that the core traci module should execute.
+        update the counts and the waiting times for all lanes by passing the subscription updates
 
-        @param traci_c:
-        @return:
+        @return: a list of the (count, waiting time) of every lane of every phase
         """
-        # self.traci_c = traci_c
-        for child in self:
-            child.register_traci(traci_c)
-
-        return (
-            (traci_c.lane.getAllSubscriptionResults, (), VAR_LANES),
-            (traci_c.vehicle.getAllSubscriptionResults, (), VAR_VEHICLE),
-        )
+        if self._engine is None:
+            return super().get_counts(sim_dict)
+        lanes = list(zip(self._engine_values(sim_dict, "count"), self._engine_values(sim_dict, "waiting_time")))
+        return [lanes[s] for s in self._phase_slices]
 
     def get_waiting_time(
         self, mapped_method: bool = False
@@ -243,7 +203,7 @@ class GlobalWaitingTimeObserver(GlobalPhaseObservations):
         if mapped_method:
             return {t.name: t.get_waiting_time(mapped_method) for t in self._children}
         else:
-            return (l[1] for a in self.count_list for l in a.count_list)
+            return (l[1] for tl in self.tls for phase in tl.collect() for l in phase)
 
 
     def get_vehicle_ids(
@@ -253,4 +213,3 @@ class GlobalWaitingTimeObserver(GlobalPhaseObservations):
             return {t.name: t.get_vehicle_ids() for t in self._children}
         else:
             return (a.get_vehicle_ids() for a in self._children)
-    
@@ -0,0 +1,227 @@
+"""
+The observation tree (GlobalObservations -> TLObservations -> Approach/Phase -> Lane), flattened once into arrays.
+
+Every Lane of the tree is a "slot". The SUMO lanes map to the slots through a CSR index (a SUMO lane can be watched by
+the cameras of more than one traffic light), and every slot has the camera center of its traffic light.
+A step is then a gather over the vehicles' SUMO lanes and a bincount over the slots, no matter how deep the tree is.
+
+The vehicles get integer codes, so that the sticky "seen by this lane's camera in the last step" state is a boolean
+array indexed by vehicle code * slot number + slot, rather than a set of strings per lane
+"""
+from itertools import chain
+from typing import Dict, List
+
+import numpy as np
+from traci.constants import LAST_STEP_VEHICLE_ID_LIST, LAST_STEP_VEHICLE_NUMBER, VAR_LANEPOSITION, VAR_POSITION
+
+from .observer import DISTANCE_THRESHOLD, xy_to_m
+
+_EMPTY = np.empty(0, dtype=np.int64)
+
+
+class CompiledLanes:
+    def __init__(self, slot_lanes: List[List[str]], slot_centers: List[tuple],
+                 slot_inside_lanes: List[List[str]] = None, slot_cutoffs: List[Dict[str, tuple]] = None):
+        """
+        Args:
+            slot_lanes (List[List[str]]): the SUMO lanes of every slot whose vehicles are checked (Lane.id_lanes)
+            slot_centers (List[tuple]): the camera center (x, y) of every slot
+            slot_inside_lanes (List[List[str]], optional): the SUMO lanes of every slot that are counted by SUMO
+                (Lane.inside_lanes, hybrid mode). Defaults to None.
+            slot_cutoffs (List[Dict[str, tuple]], optional): the stretch of every SUMO lane of every slot that the camera
+                sees (Lane.cutoffs). The vehicles are then checked by VAR_LANEPOSITION. Defaults to None.
+        """
+        self.slot_num = len(slot_lanes)
+
+        # the SUMO lanes, in the order of their first slot
+        lane_slots: Dict[str, List[int]] = {}
+        for slot, lanes in enumerate(slot_lanes):
+            for lane in lanes:
+                lane_slots.setdefault(lane, []).append(slot)
+        self.sumo_lanes: List[str] = list(lane_slots)
+
+        # CSR: the slots of SUMO lane i are indices[indptr[i]:indptr[i + 1]]
+        self._lane_slot_num = np.array([len(slots) for slots in lane_slots.values()], dtype=np.int64)
+        self._indptr = np.concatenate([[0], np.cumsum(self._lane_slot_num)])
+        self._indices = np.array([slot for slots in lane_slots.values() for slot in slots], dtype=np.int64)
+        # most SUMO lanes belong to a single slot, which skips the expansion
+        self._one_slot_each = bool(np.all(self._lane_slot_num == 1))
+
+        self._centers = np.array(slot_centers, dtype=np.float64).reshape(-1, 2)
+
+        # the (start, end) lane positions of every (SUMO lane, slot) entry of the CSR index
+        self._by_lane_position = slot_cutoffs is not None
+        if self._by_lane_position:
+            cutoffs = [slot_cutoffs[slot][lane] for lane, slots in lane_slots.items() for slot in slots]
+            self._starts = np.array([start for start, _ in cutoffs], dtype=np.float64)
+            self._ends = np.array([end for _, end in cutoffs], dtype=np.float64)
+
+        # the (SUMO lane, slot) pairs that are added by their vehicle number
+        pairs = [(lane, slot) for slot, lanes in enumerate(slot_inside_lanes or ()) for lane in lanes]
+        self._inside_lanes: List[str] = [lane for lane, _ in pairs]
+        self._inside_slots = np.array([slot for _, slot in pairs], dtype=np.int64)
+
+        self._codes: Dict[str, int] = {}
+        # whether the vehicle (code) was inside the slot in the last step, by code * slot_num + slot.
+        # It grows with the number of vehicles in an episode
+        self._was_inside = np.zeros(1024 * self.slot_num, dtype=bool)
+        # the keys that are set, so that they can be unset
+        self._inside_keys = _EMPTY
+
+        # the subscription results and the counts of the last step. If the results are the same and the camera saw
+        # every vehicle, nothing can have changed
+        self._last_results: List[tuple] = None
+        self._last_counts: np.ndarray = None
+        self._all_seen = False
+
+        # the vehicle ids of the last count and the (vehicle index, slot) pairs that the camera saw,
+        # for summing the vehicle variables with sum_seen and for seen_ids
+        self._ids: List[str] = []
+        self._seen_vehicles = _EMPTY
+        self._seen_slots = _EMPTY
+
+    def reset(self, ) -> None:
+        self._codes.clear()
+        self._was_inside[self._inside_keys] = False
+        self._inside_keys = _EMPTY
+        self._last_results = None
+        self._all_seen = False
+        self._ids = []
+        self._seen_vehicles = self._seen_slots = _EMPTY
+
+    def count(self, lane_info: dict, vehicle_info: dict) -> np.ndarray:
+        """
+        Count the vehicles that the camera sees in every slot
+
+        Args:
+            lane_info (dict): {lane_ids: {18: [id_list]}}
+            vehicle_info (dict): {ids: {VAR_POSITION: position}}. Vehicles that aren't in it are outside
+
+        Returns:
+            np.ndarray: the (slot_num, ) counts
+        """
+        counts = self._count_ids(lane_info, vehicle_info)
+        if self._inside_lanes:
+            numbers = [lane_info[lane][LAST_STEP_VEHICLE_NUMBER] for lane in self._inside_lanes]
+            counts += np.bincount(self._inside_slots, weights=numbers, minlength=self.slot_num).astype(np.int64)
+        return counts
+
+    def _count_ids(self, lane_info: dict, vehicle_info: dict) -> np.ndarray:
+        lane_ids = [lane_info[lane][LAST_STEP_VEHICLE_ID_LIST] for lane in self.sumo_lanes]
+        if self._all_seen and lane_ids == self._last_results:
+            return self._last_counts.copy()
+        self._last_results = lane_ids
+        self._last_counts = self._count_new_ids(lane_ids, vehicle_info)
+        return self._last_counts.copy()
+
+    def _count_new_ids(self, lane_ids: List[tuple], vehicle_info: dict) -> np.ndarray:
+        ids = list(chain.from_iterable(lane_ids))
+
+        self._ids = ids
+        if not ids:
+            self._was_inside[self._inside_keys] = False
+            self._inside_keys = _EMPTY
+            self._seen_vehicles = self._seen_slots = _EMPTY
+            self._all_seen = True
+            return np.zeros(self.slot_num, dtype=np.int64)
+
+        codes = self._codes
+        new_ids = [_id for _id in ids if _id not in codes]
+        if new_ids:
+            codes.update(zip(new_ids, range(len(codes), len(codes) + len(new_ids))))
+            if len(codes) * self.slot_num > len(self._was_inside):
+                was_inside = np.zeros(2 * len(codes) * self.slot_num, dtype=bool)
+                was_inside[:len(self._was_inside)] = self._was_inside
+                self._was_inside = was_inside
+        vehicle_codes = np.fromiter(map(codes.__getitem__, ids), dtype=np.int64, count=len(ids))
+        vehicle_lanes = np.repeat(
+            np.arange(len(lane_ids)), np.fromiter(map(len, lane_ids), dtype=np.int64, count=len(lane_ids))
+        )
+
+        # a (vehicle, slot) pair for every slot of every vehicle's lane, and its entry in the CSR index
+        if self._one_slot_each:
+            vehicles = np.arange(len(ids))
+            entries = vehicle_lanes
+        else:
+            slot_num = self._lane_slot_num[vehicle_lanes]
+            vehicles = np.repeat(np.arange(len(ids)), slot_num)
+            first = np.repeat(self._indptr[vehicle_lanes] - (np.cumsum(slot_num) - slot_num), slot_num)
+            entries = first + np.arange(len(vehicles))
+        slots = self._indices[entries]
+
+        keys = vehicle_codes[vehicles] * self.slot_num + slots
+
+        # if it was there last time, it will be there this timestep. Assuming that cars do not travel backwards
+        inside = self._was_inside[keys]
+
+        new = np.flatnonzero(~inside)
+        if len(new):
+            new_vehicles = [ids[v] for v in vehicles[new].tolist()]
+            if any(_id not in vehicle_info for _id in new_vehicles):
+                # in context mode SUMO only sends the vehicles around the junctions, the rest are outside
+                known = np.fromiter((_id in vehicle_info for _id in new_vehicles), dtype=bool, count=len(new))
+                new, new_vehicles = new[known], [_id for _id, _known in zip(new_vehicles, known) if _known]
+            if self._by_lane_position:
+                positions = np.fromiter(
+                    (vehicle_info[_id][VAR_LANEPOSITION] for _id in new_vehicles), dtype=np.float64, count=len(new)
+                )
+                inside[new] = (self._starts[entries[new]] <= positions) & (positions <= self._ends[entries[new]])
+            else:
+                inside[new] = self._is_inside(new_vehicles, slots[new], vehicle_info)
+
+        self._was_inside[self._inside_keys] = False
+        self._inside_keys = keys[inside]
+        self._was_inside[self._inside_keys] = True
+        self._all_seen = bool(inside.all())
+        self._seen_vehicles, self._seen_slots = vehicles[inside], slots[inside]
+        return np.bincount(self._seen_slots, minlength=self.slot_num)
+
+    def sum_seen(self, lane_info: dict, vehicle_info: dict, variable: int) -> np.ndarray:
+        """
+        Sum a vehicle variable over the vehicles that the camera saw in the last count, for every slot.
+        The inside lanes add the lane's own value of the variable, which SUMO sums over all of its vehicles
+
+        Args:
+            lane_info (dict): {lane_ids: {variable: value}}
+            vehicle_info (dict): {ids: {variable: value}}. The vehicles that aren't in it (anymore) add 0
+            variable (int): a traci variable that is both a vehicle and a lane variable, like VAR_WAITING_TIME
+
+        Returns:
+            np.ndarray: the (slot_num, ) sums
+        """
+        sums = np.zeros(self.slot_num, dtype=np.float64)
+        # (bincount of nothing is an integer array, even with weights)
+        if len(self._seen_slots):
+            values = np.fromiter(
+                (vehicle_info[_id][variable] if _id in vehicle_info else 0. for _id in self._ids),
+                dtype=np.float64, count=len(self._ids)
+            )
+            sums += np.bincount(self._seen_slots, weights=values[self._seen_vehicles], minlength=self.slot_num)
+        if self._inside_lanes:
+            lane_values = [lane_info[lane][variable] for lane in self._inside_lanes]
+            sums += np.bincount(self._inside_slots, weights=lane_values, minlength=self.slot_num)
+        return sums
+
+    def seen_ids(self, ) -> List[List[str]]:
+        """
+        The ids of the vehicles that the camera saw in the last count, for every slot, in the order of the lanes' id lists.
+        The vehicles on the inside lanes are only counted by SUMO, so they aren't in them
+        """
+        slot_ids = [[] for _ in range(self.slot_num)]
+        for vehicle, slot in zip(self._seen_vehicles.tolist(), self._seen_slots.tolist()):
+            slot_ids[slot].append(self._ids[vehicle])
+        return slot_ids
+
+    def _is_inside(self, vehicles: List[str], slots: np.ndarray, vehicle_info: dict) -> np.ndarray:
+        """
+        Whether the vehicles are within the camera radius of their slots, by their x, y position
+        """
+        positions = np.array([vehicle_info[_id][VAR_POSITION] for _id in vehicles], dtype=np.float64)
+        positions = positions.reshape(-1, 2)
+        centers = self._centers[slots]
+        distance = np.sqrt(np.square(positions[:, 0] - centers[:, 0]) + np.square(positions[:, 1] - centers[:, 1]))
+        is_inside = distance <= DISTANCE_THRESHOLD
+        # sqrt and pow can round differently, so the (rare) vehicles right at the threshold are checked with xy_to_m
+        for i in np.flatnonzero(np.abs(distance - DISTANCE_THRESHOLD) < 1e-9):
+            is_inside[i] = xy_to_m(*centers[i], *positions[i]) <= DISTANCE_THRESHOLD
+        return is_inside
@@ -0,0 +1,174 @@
+"""
+One pass over the step's subscription results for any number of observers (see GlobalObservations.compile_topology).
+
+Every observer registers its lanes as slots. Slots that are the same (the same SUMO lanes, camera and lane constants) are
+shared, so observers that watch the same lanes don't check their vehicles twice. A step checks the vehicles of all of
+the slots at once (compiled.py) and derives the requested features from that as array math:
+
+    count:   the number of vehicles that the camera sees on the lane
+    density: count / the permissible vehicles on the lane * direction (1 incoming, -1 outgoing), like MaxPressureLane
+    waiting_time: the VAR_WAITING_TIME sum of the vehicles that the camera sees on the lane. It comes with the vehicle
+                  positions, so the observer has to subscribe to it (GlobalObservations.vehicle_variables)
+
+The ids of the vehicles that the camera saw are kept per slot as well (vehicle_ids).
+
+The observers are views, an array of slot indices into the feature arrays, and so are the Lane, MaxPressureLane and
+WaitingTimeLane nodes of their trees (one slot each). Per phase values are array math on top of the views too, like
+MaxPressureGlobalObservations.get_phase_pressure (its incidence matrix times the densities).
+
+Every observer counts through an engine, except in lanearea mode, where SUMO counts the vehicles of its detectors
+"""
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from traci.constants import VAR_LANES, VAR_WAITING_TIME
+
+from .compiled import CompiledLanes
+
+FEATURES = ("count", "density", "waiting_time")
+
+
+class ObservationEngine:
+    def __init__(self, features: Iterable[str] = ("count", )):
+        """
+        Args:
+            features (Iterable[str], optional): the features to compute (see FEATURES). The observers that are added
+                request theirs too. Defaults to ("count", ).
+        """
+        self.features = set()
+        self.request(features)
+
+        # {feature: (slot_num, ) array} of the last step
+        self.values: Dict[str, np.ndarray] = {}
+
+        # set by the first observer, every other one has to match
+        self._vehicle_key = None
+        self._lane_positions: bool = None
+
+        # the slots, by what makes them the same
+        self._slot_index: Dict[tuple, int] = {}
+        self._slot_lanes: List[List[str]] = []
+        self._slot_centers: List[tuple] = []
+        self._slot_inside_lanes: List[List[str]] = []
+        self._slot_cutoffs: List[dict] = []
+        self._capacity: List[float] = []
+        self._direction: List[float] = []
+
+        # built on the first step, once all of the observers are added
+        self._compiled: CompiledLanes = None
+        self._capacity_array: np.ndarray = None
+        self._direction_array: np.ndarray = None
+
+        # the simulation data of the last step, so that every observer of a step shares the work
+        self._last_sim_dict: dict = None
+        # the vehicle ids of the last step, gathered on the first vehicle_ids call
+        self._vehicle_ids: List[List[str]] = None
+
+    def request(self, features: Iterable[str]) -> None:
+        """
+        Compute these features as well
+
+        Args:
+            features (Iterable[str]): see FEATURES
+        """
+        for feature in features:
+            if feature not in FEATURES:
+                raise ValueError(f"unknown feature {feature}, expected one of {FEATURES}")
+            self.features.add(feature)
+
+    def add_lanes(self, lanes: List[Tuple[object, tuple]], vehicle_key, lane_positions: bool) -> np.ndarray:
+        """
+        Add the lanes of an observer
+
+        Args:
+            lanes (List[Tuple[Lane, tuple]]): (Lane, camera center) of every lane, in the observer's order
+            vehicle_key: where the observer's vehicles are in the simulation data
+            lane_positions (bool): whether the observer checks the vehicles by their lane positions
+
+        Returns:
+            np.ndarray: the slots of the lanes
+        """
+        if self._compiled is not None:
+            raise RuntimeError("The observers have to be added before the first step")
+        if self._vehicle_key is None:
+            self._vehicle_key, self._lane_positions = vehicle_key, lane_positions
+        elif (vehicle_key, lane_positions) != (self._vehicle_key, self._lane_positions):
+            raise ValueError("The observers of an engine need the same observation mode and lane position setting")
+
+        slots = []
+        for lane, center in lanes:
+            capacity = getattr(lane, "_max_permissible_vehicles", 1)
+            cutoffs = tuple(sorted(lane.cutoffs.items())) if lane.cutoffs is not None else None
+            key = (tuple(lane.id_lanes), tuple(lane.inside_lanes), tuple(center), cutoffs, capacity, lane._direction)
+            if key not in self._slot_index:
+                self._slot_index[key] = len(self._slot_lanes)
+                self._slot_lanes.append(list(lane.id_lanes))
+                self._slot_centers.append(center)
+                self._slot_inside_lanes.append(list(lane.inside_lanes))
+                self._slot_cutoffs.append(lane.cutoffs)
+                self._capacity.append(capacity)
+                self._direction.append(lane._direction.value)
+            slots.append(self._slot_index[key])
+        return np.array(slots, dtype=np.int64)
+
+    @property
+    def slot_num(self, ) -> int:
+        return len(self._slot_lanes)
+
+    def _build(self, ) -> None:
+        self._compiled = CompiledLanes(
+            slot_lanes=self._slot_lanes,
+            slot_centers=self._slot_centers,
+            slot_inside_lanes=self._slot_inside_lanes,
+            slot_cutoffs=self._slot_cutoffs if self._lane_positions else None,
+        )
+        self._capacity_array = np.array(self._capacity, dtype=np.float64)
+        self._direction_array = np.array(self._direction, dtype=np.float64)
+
+    def reset(self, ) -> None:
+        if self._compiled is not None:
+            self._compiled.reset()
+        self._last_sim_dict = None
+        self.values = {}
+        self._vehicle_ids = None
+
+    def vehicle_ids(self, ) -> List[List[str]]:
+        """
+        The ids of the vehicles that the camera saw in every slot in the last step (update).
+        The vehicles on the lanes that SUMO counts (hybrid mode) aren't known by their ids
+
+        Returns:
+            List[List[str]]: the ids of every slot
+        """
+        if self._compiled is None:
+            return [[] for _ in range(self.slot_num)]
+        if self._vehicle_ids is None:
+            self._vehicle_ids = self._compiled.seen_ids()
+        return self._vehicle_ids
+
+    def update(self, sim_dict: dict) -> Dict[str, np.ndarray]:
+        """
+        Compute the features of a step. Only the first call with the step's simulation data does the work
+
+        Args:
+            sim_dict (dict): the simulation data of the step (Kernel.sim_data)
+
+        Returns:
+            Dict[str, np.ndarray]: {feature: (slot_num, ) array}
+        """
+        if sim_dict is self._last_sim_dict:
+            return self.values
+        if self._compiled is None:
+            self._build()
+
+        lane_info, vehicle_info = sim_dict[VAR_LANES], sim_dict[self._vehicle_key]
+        counts = self._compiled.count(lane_info, vehicle_info)
+        self.values["count"] = counts
+        if "density" in self.features:
+            self.values["density"] = counts / self._capacity_array * self._direction_array
+        if "waiting_time" in self.features:
+            self.values["waiting_time"] = self._compiled.sum_seen(lane_info, vehicle_info, VAR_WAITING_TIME)
+
+        self._last_sim_dict = sim_dict
+        self._vehicle_ids = None
+        return self.values
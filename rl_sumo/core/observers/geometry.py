@@ -0,0 +1,84 @@
+"""
+Where the SUMO lanes are relative to the camera at the center of a traffic light
+"""
+from enum import Enum
+from typing import List, Optional, Tuple
+
+import sumolib
+
+
+class LanePlacement(Enum):
+    INSIDE = 0
+    OUTSIDE = 1
+    BOUNDARY = 2
+
+
+def _segment_in_radius(p0: tuple, p1: tuple, center: tuple, radius: float) -> Optional[Tuple[float, float]]:
+    """
+    The part of the segment p0 -> p1 that is within the radius of the center, as fractions of the segment
+
+    @return: (t_start, t_end) in [0, 1] or None if the segment is outside of the radius
+    """
+    dx, dy = p1[0] - p0[0], p1[1] - p0[1]
+    fx, fy = p0[0] - center[0], p0[1] - center[1]
+    a = dx * dx + dy * dy
+    if a == 0:
+        return (0., 1.) if fx * fx + fy * fy <= radius ** 2 else None
+    # |p0 + t * (p1 - p0) - center| = radius
+    b = 2 * (fx * dx + fy * dy)
+    c = fx * fx + fy * fy - radius ** 2
+    discriminant = b * b - 4 * a * c
+    if discriminant < 0:
+        return None
+    root = discriminant ** (1 / 2)
+    t_start, t_end = max((-b - root) / (2 * a), 0.), min((-b + root) / (2 * a), 1.)
+    return (t_start, t_end) if t_start <= t_end else None
+
+
+def lane_interval_in_radius(lane: sumolib.net.lane.Lane, center: tuple,
+                            radius: float) -> Optional[Tuple[float, float]]:
+    """
+    The stretch of the lane that is within the radius of the center, in lane positions
+    (what SUMO uses for detectors and VAR_LANEPOSITION). It goes from where the lane first enters the radius to where it
+    last leaves it, which is the whole inside part for the (mostly straight) lanes around a junction
+
+    @param lane: a sumolib lane
+    @param center: (x, y)
+    @param radius: in meters
+    @return: (start, end) or None if no part of the lane is within the radius
+    """
+    shape: List[tuple] = lane.getShape()
+    start, end, position = None, None, 0.
+    for p0, p1 in zip(shape[:-1], shape[1:]):
+        segment_length = sumolib.geomhelper.distance(p0, p1)
+        if (inside := _segment_in_radius(p0, p1, center, radius)) is not None:
+            if start is None:
+                start = position + inside[0] * segment_length
+            end = position + inside[1] * segment_length
+        position += segment_length
+
+    if start is None:
+        return None
+    # the lane's length can differ from the length of its shape
+    scale = lane.getLength() / position if position else 1.
+    return start * scale, end * scale
+
+
+def classify_lane(lane: sumolib.net.lane.Lane, center: tuple, radius: float, margin: float = 0.) -> LanePlacement:
+    """
+    Whether the lane is entirely within the radius of the center, entirely outside of it or crosses it.
+    The margin keeps the lanes that are within it of the radius (either way) on the boundary,
+    as the vehicles aren't exactly on the lane's shape
+
+    @param lane: a sumolib lane
+    @param center: (x, y)
+    @param radius: in meters
+    @param margin: in meters
+    @return: LanePlacement
+    """
+    # the distance to a point is largest at one of the ends of a segment
+    if max(sumolib.geomhelper.distance(point, center) for point in lane.getShape()) <= radius - margin:
+        return LanePlacement.INSIDE
+    if lane_interval_in_radius(lane, center, radius + margin) is None:
+        return LanePlacement.OUTSIDE
+    return LanePlacement.BOUNDARY
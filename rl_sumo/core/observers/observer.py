@@ -1,18 +1,53 @@
+import math
+import os
 from bdb import Breakpoint
 from collections import OrderedDict
 from enum import Enum
 from typing import Dict, Iterable, List, Tuple, Union
+from xml.sax.saxutils import escape
+import numpy as np
 import sumolib
 from traci.constants import (
+    CMD_GET_LANEAREA_VARIABLE,
+    CMD_GET_VEHICLE_VARIABLE,
+    LAST_STEP_OCCUPANCY,
+    LAST_STEP_VEHICLE_HALTING_NUMBER,
     LAST_STEP_VEHICLE_ID_LIST,
+    LAST_STEP_VEHICLE_NUMBER,
     VAR_VEHICLE,
+    VAR_LANEPOSITION,
     VAR_LANES,
     VAR_POSITION,
 )
-from copy import deepcopy
+
+from .geometry import LanePlacement, classify_lane, lane_interval_in_radius
 
 DISTANCE_THRESHOLD = 100  # in meters
 
+# how the observers get the vehicle positions:
+#   "vehicle": every vehicle in the network is subscribed to by the kernel
+#   "context": SUMO only sends the vehicles around each traffic light (a junction context subscription)
+#   "lanearea": no vehicles at all, SUMO counts them with generated lane-area (E2) detectors
+#   "hybrid": the lanes that are entirely inside of the camera's view are counted by SUMO (vehicle number),
+#             only the vehicles on the lanes that cross the radius are checked, with a junction context
+VEHICLE_MODE = "vehicle"
+CONTEXT_MODE = "context"
+LANEAREA_MODE = "lanearea"
+HYBRID_MODE = "hybrid"
+OBSERVATION_MODES = (VEHICLE_MODE, CONTEXT_MODE, LANEAREA_MODE, HYBRID_MODE)
+
+# the key of the context vehicles in the simulation data
+CONTEXT_VEHICLES = "context_vehicles"
+# the context radius is a bit larger than the camera's, so that the exact distance check is done on every vehicle it needs
+CONTEXT_MARGIN = 1  # in meters
+
+DETECTOR_SUBSCRIPTIONS = [LAST_STEP_VEHICLE_NUMBER, LAST_STEP_VEHICLE_HALTING_NUMBER, LAST_STEP_OCCUPANCY]
+# shorter stretches of a lane inside of the camera radius don't get a detector
+MIN_DETECTOR_LENGTH = 0.1  # in meters
+
+# the cutoffs of a lane that the camera doesn't see at all
+NEVER_INSIDE = (math.inf, -math.inf)
+
 
 
 def read_net(path: str) -> sumolib.net:
@@ -56,23 +91,31 @@ class _Base:
         self.name = name
         self._children: List[_Base] = children
         self.count_list = [child.count_list for child in self]
-        self.init_state = None
 
         self._val_map = {}
 
-    def freeze(
-        self,
-    ):
-        self.init_state = deepcopy(self.__dict__)
-        for child in self:
-            child.freeze()
+    def collect(self, ):
+        """
+        Gather the values of the children. The lanes read theirs from the engine (or from their lane-area detectors)
 
-    def re_initialize(self):
+        @return: self.count_list
+        """
+        self.count_list[:] = [child.collect() for child in self._children]
+        return self.count_list
 
-        for name, value in deepcopy(self.init_state).items():
-            self.__dict__[name] = value
+    def re_initialize(self):
+        """
+        Reset the per-episode state of this node and all of its children in place
+        """
+        self._reset_state()
+        for child in self:
+            child.re_initialize()
 
-        self.freeze()
+    def _reset_state(self):
+        """
+        Reset the per-episode state of only this node. Extended by the children classes
+        """
+        self.count_list.clear()
 
     def get_lane_count(
         self,
@@ -119,9 +162,29 @@ class Lane(_Base):
     1. the count of vehicles in the lane
     2. the SUMO name of the lane
 
+    The lane is a view of its slot in the ObservationEngine's arrays (see GlobalObservations.compile_topology),
+    except in lanearea mode, where it stores what its lane-area detectors report.
+
     It can be extended in the future
     """
 
+    # set by GlobalObservations.compile_topology: the engine that the lane reads its values from and its slot in it
+    _engine = None
+    _slot: int = None
+    # the count in lanearea mode
+    _count = 0
+    # in lanearea mode, the lane-area detectors of the lane {detector id: length}
+    detectors: Dict[str, float] = None
+    # the halting vehicles and the (length weighted) occupancy in % of the detectors. Only in lanearea mode
+    halting_number = 0
+    occupancy = 0.
+    # in hybrid mode, the SUMO lanes that are entirely inside of the camera's view (counted by SUMO)
+    # and the ones whose vehicles are checked one by one
+    inside_lanes: List[str] = ()
+    _id_lanes: List[str] = None
+    # with lane positions, the stretch of every SUMO lane that the camera sees {lane id: (start, end)}
+    cutoffs: Dict[str, Tuple[float, float]] = None
+
     def __init__(self, lane_list: List[str], direction: LaneType = LaneType.INCOMING, *args, **kwargs):
         """
         Initialising the base class
@@ -132,16 +195,47 @@ class Lane(_Base):
         # a "lane" can actually be composed of multiple lanes in the SUMO network
         self._lane_list = [l.getID() for l in lane_list]
 
-        # the count of cars in each lane (list to emulate a pointer)
-        self.count = 0
-        # the ids of the cars in the lane during the last time step
-        self._last_ids = []
         # subscribe to all of the lanes
         # self._subscribe_2_lanes()
         
         # a storage of the direction (either incoming or outgoing)
         self._direction: LaneType = direction
 
+    def _reset_state(self):
+        super()._reset_state()
+        # an empty lane, which also resets what the children classes derive from the count
+        self._set_count(0)
+        self.halting_number = 0
+        self.occupancy = 0.
+
+    def view(self, engine, slot: int) -> None:
+        """
+        Read the values of the lane from an ObservationEngine from now on
+
+        @param engine: the ObservationEngine
+        @param slot: the lane's slot in the engine's arrays
+        @return: None
+        """
+        self._engine = engine
+        self._slot = slot
+
+    def _engine_value(self, feature: str):
+        """
+        The lane's value of an engine feature in the last step. 0 before the first step of an episode
+
+        @param feature: see engine.FEATURES
+        @return: the value
+        """
+        values = self._engine.values.get(feature)
+        return 0 if values is None else values[self._slot].item()
+
+    @property
+    def count(self, ) -> int:
+        """
+        The number of vehicles that the camera sees on the lane
+        """
+        return self._count if self._engine is None else self._engine_value("count")
+
     @property
     def lanes(
         self,
@@ -152,6 +246,26 @@ class Lane(_Base):
     def lanes(self, val: List[str]) -> None:
         self._lane_list = val
 
+    @property
+    def id_lanes(
+        self,
+    ) -> List[str]:
+        """
+        The SUMO lanes whose vehicles are checked by the camera. All of them, except in hybrid mode
+        """
+        return self._lane_list if self._id_lanes is None else self._id_lanes
+
+    def split_lanes(self, inside_lanes: List[str], id_lanes: List[str]) -> None:
+        """
+        Count the vehicles on some of the SUMO lanes without checking them (hybrid mode). The rest are ignored
+
+        @param inside_lanes: the SUMO lanes that are entirely inside of the camera's view
+        @param id_lanes: the SUMO lanes whose vehicles are checked
+        @return: None
+        """
+        self.inside_lanes = inside_lanes
+        self._id_lanes = id_lanes
+
     def get_lane_count(
         self,
     ):
@@ -172,37 +286,43 @@ class Lane(_Base):
 
             traci_c.lane.subscribe(lane, [LAST_STEP_VEHICLE_ID_LIST])
 
-    def update_counts(self, center: tuple, lane_info: dict, vehicle_info: dict) -> None:
+    def update_counts(self, detector_info: dict = None, **kwargs):
+        """
+        this function redefines the _Base update_counts. In lanearea mode the lane is updated from its detectors,
+        otherwise it reads the engine, which the observer updates once for all of the lanes
+
+        @param detector_info: {detector_ids: {LAST_STEP_VEHICLE_NUMBER: number, ...}}
+        @return: the lane's value (see get_counts)
         """
-        this function redefines the _Base update_counts and implements the logic for each lane
+        if detector_info is not None:
+            self.update_detectors(detector_info)
+        return self.get_counts()
 
-        @param vehicle_positions: {ids: positions}
-        @param lane_ids: {lane_ids: {18: [id_list]}}
-        @param center: the center of the intersection (simulating where a camera would be placed)
+    def _set_count(self, count: int) -> None:
+        """
+        Store the number of vehicles that the detectors see on the lane (lanearea mode). Extended by the children classes
+
+        @param count: the number of vehicles
         @return: None
         """
-        # call traci to get the ids of vehicles in each of the lanes
-        ids = []
-        for lane in self._lane_list:
-            ids.extend(lane_info[lane][18])
-        # loop through the ids, only checking the distance for those that are "new" to the network
-        new_ids = []
-        if len(ids):
-            for _id in ids:
-                # if it was there last time, it will be there this timestep. Assuming that cars do not travel backwards
-                if _id in self._last_ids:
-                    new_ids.append(_id)
-
-                elif (
-                    xy_to_m(*center, *vehicle_info[_id][VAR_POSITION])
-                    <= DISTANCE_THRESHOLD
-                ):
-                    new_ids.append(_id)
-
-        # assign these new ids to the history
-        self._last_ids = new_ids
-        self.count = len(new_ids)
-        return self.count
+        self._count = count
+
+    def update_detectors(self, detector_info: dict) -> None:
+        """
+        Update the lane from its lane-area detectors (lanearea mode)
+
+        @param detector_info: {detector_ids: {LAST_STEP_VEHICLE_NUMBER: number, ...}}
+        @return: None
+        """
+        results = [(detector_info[d], length) for d, length in self.detectors.items()]
+        self._set_count(sum(r[LAST_STEP_VEHICLE_NUMBER] for r, _ in results))
+        self.halting_number = sum(r[LAST_STEP_VEHICLE_HALTING_NUMBER] for r, _ in results)
+        total_length = sum(self.detectors.values())
+        if total_length:
+            self.occupancy = sum(r[LAST_STEP_OCCUPANCY] * length for r, length in results) / total_length
+
+    def collect(self, ):
+        return self.get_counts()
 
     def get_counts(
         self,
@@ -353,6 +473,9 @@ class TLObservations(_Base):
         # loop through the children and try to remove duplicate lanes from children
         self._clear_duplicate_lanes()
 
+        # all of the lanes, in the order of the observation
+        self._lanes: List[Lane] = [lane for child in self for lane in child]
+
     def _clear_duplicate_lanes(
         self,
     ) -> None:
@@ -402,26 +525,36 @@ class TLObservations(_Base):
         return net_obj.getCoord()
 
     def update_counts(
-        self, **kwargs
+        self, detector_info: dict = None, **kwargs
     ) -> List[List,]:
         """
-        This function calls update_counts on the children and passes the center coordinates
+        This function updates the lanes from their lane-area detectors (lanearea mode) and then collects the counts
+        from the children. In the other modes the lanes read the engine, which the observer updates
 
-        @param kwargs: a forgiving list of inputs
+        @param detector_info: {detector_ids: {LAST_STEP_VEHICLE_NUMBER: number, ...}}
         @return: a list of lists
         """
-        self.count_list.clear()
-        for child in self:
-            self.count_list.extend(child.update_counts(center=self._center, **kwargs))
-        return self.count_list.copy()
+        if detector_info is not None:
+            for lane in self._lanes:
+                lane.update_detectors(detector_info)
+        return self.collect().copy()
+
+    def collect(self, ):
+        """
+        The values of all of the lanes, in one list
+
+        @return: self.count_list
+        """
+        self.count_list[:] = [value for child in self for value in child.collect()]
+        return self.count_list
 
     def get_counts(
         self, mapped_method: bool = False
     ) -> Union[List[int], Dict[str, int]]:
         if mapped_method:
-            return {t.name: t.count_list for t in self._children}
+            return {t.name: t.collect() for t in self._children}
         else:
-            return self.count_list
+            return self.collect()
 
 
 class GlobalObservations(_Base):
@@ -431,11 +564,23 @@ class GlobalObservations(_Base):
 
     distance_threshold = DISTANCE_THRESHOLD
 
+    # set by compile_topology: the engine that counts and this observer's slots in its feature arrays
+    _engine = None
+    _slots: np.ndarray = None
+    # the features that get_counts reads from the engine
+    engine_features = ("count", )
+    # the vehicle variables that are subscribed to along with the camera's position variable,
+    # and the lane variables of the lanes that are counted by SUMO (hybrid mode)
+    vehicle_variables: Tuple[int] = ()
+    inside_lane_variables: Tuple[int] = ()
+
     def __init__(
         self,
         net_file: str,
         tl_ids: list,
         name: str,
+        mode: str = VEHICLE_MODE,
+        lane_positions: bool = False,
     ):
         """
         Instantiating the GlobalObservations class
@@ -443,12 +588,120 @@ class GlobalObservations(_Base):
         @param net_file: the net file path
         @param tl_ids: a list of traffic light ids
         @param name: the name of the object
-        @param traci_instance: the traci instance
+        @param mode: how the vehicle positions are subscribed to (one of OBSERVATION_MODES)
+        @param lane_positions: check the vehicles by their position along the lane instead of their x, y position
         """
         self._tl_ids = tl_ids
-        super().__init__(name, children=self._compose_tls(read_net(net_file)))
-        # freeze all the initial values
-        self.freeze()
+        self._set_mode(mode, lane_positions)
+        net = read_net(net_file)
+        super().__init__(name, children=self._compose_tls(net))
+        self._prepare_lanes(net)
+
+    def _set_mode(self, mode: str, lane_positions: bool) -> None:
+        if mode not in OBSERVATION_MODES:
+            raise ValueError(f"unknown observation mode {mode}, expected one of {OBSERVATION_MODES}")
+        self.mode = mode
+        self.lane_positions = lane_positions
+        # the vehicle variable that the camera checks
+        self._position_variable = VAR_LANEPOSITION if lane_positions else VAR_POSITION
+        # where the vehicle positions are in the simulation data
+        self._vehicle_key = CONTEXT_VEHICLES if mode in (CONTEXT_MODE, HYBRID_MODE) else VAR_VEHICLE
+        # the lane-area detectors {detector id: (lane id, start position, end position)}
+        self._detectors: Dict[str, Tuple[str, float, float]] = {}
+
+    def _prepare_lanes(self, net_obj) -> None:
+        """
+        Called once the tree is built, to set the lanes up for the observation mode.
+        Except in lanearea mode, the lanes are then added to an ObservationEngine of their own
+
+        @param net_obj: the sumolib.net object
+        @return: None
+        """
+        if self.mode == LANEAREA_MODE:
+            self._compose_detectors(net_obj)
+            return
+        if self.mode == HYBRID_MODE:
+            self._classify_lanes(net_obj)
+        if self.lane_positions:
+            self._compose_cutoffs(net_obj)
+        self.compile_topology()
+
+    def _compose_cutoffs(self, net_obj) -> None:
+        """
+        The stretch of every observed SUMO lane that the camera sees, in lane positions (see CompiledLanes)
+
+        @param net_obj: the sumolib.net object
+        @return: None
+        """
+        for tl in self.tls:
+            for lane in tl._lanes:
+                lane.cutoffs = {
+                    l: lane_interval_in_radius(net_obj.getLane(l), tl._center, DISTANCE_THRESHOLD) or NEVER_INSIDE
+                    for l in lane.lanes
+                }
+
+    def _classify_lanes(self, net_obj) -> None:
+        """
+        In hybrid mode, the SUMO lanes that are entirely inside of the camera's view are counted by SUMO,
+        the ones that are entirely outside of it are dropped, and only the vehicles on the rest are checked.
+
+        The outgoing lanes always keep their vehicles, as a vehicle that was seen stays seen when it drives away
+
+        @param net_obj: the sumolib.net object
+        @return: None
+        """
+        for tl in self.tls:
+            for lane in tl._lanes:
+                if lane._direction == LaneType.OUTGOING:
+                    continue
+                placements = {
+                    l: classify_lane(net_obj.getLane(l), tl._center, DISTANCE_THRESHOLD, CONTEXT_MARGIN)
+                    for l in lane.lanes
+                }
+                lane.split_lanes(
+                    inside_lanes=[l for l, p in placements.items() if p == LanePlacement.INSIDE],
+                    id_lanes=[l for l, p in placements.items() if p == LanePlacement.BOUNDARY],
+                )
+
+    def _compose_detectors(self, net_obj) -> None:
+        """
+        In lanearea mode, a lane-area detector covers the part of every observed SUMO lane that the camera sees.
+        The detectors are written to an additional file with write_detector_file
+
+        @param net_obj: the sumolib.net object
+        @return: None
+        """
+        for tl in self.tls:
+            for lane in tl._lanes:
+                lane.detectors = {}
+                for lane_id in lane.lanes:
+                    detector_id = f"{tl._tl_id}_{lane_id}"
+                    if detector_id not in self._detectors:
+                        interval = lane_interval_in_radius(net_obj.getLane(lane_id), tl._center, DISTANCE_THRESHOLD)
+                        if interval is None or interval[1] - interval[0] < MIN_DETECTOR_LENGTH:
+                            continue
+                        self._detectors[detector_id] = (lane_id, *interval)
+                    _, start, end = self._detectors[detector_id]
+                    lane.detectors[detector_id] = end - start
+
+    def write_detector_file(self, path: str) -> None:
+        """
+        Write the lane-area detectors to a SUMO additional file. Their output is discarded, they are only subscribed to
+
+        @param path: the file path
+        @return: None
+        """
+        lines = ["<additional>"]
+        for detector_id, (lane_id, start, end) in self._detectors.items():
+            lines.append(
+                f'    <laneAreaDetector id="{escape(detector_id)}" lane="{escape(lane_id)}" pos="{start:.2f}" '
+                f'endPos="{end:.2f}" file="NUL" friendlyPos="true"/>'
+            )
+        lines.append("</additional>")
+        # write and then rename, so that a SUMO that is starting never reads a partial file
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
 
     def __iter__(self) -> Iterable[TLObservations]:
         yield from super().__iter__()
@@ -479,40 +732,62 @@ class GlobalObservations(_Base):
             for tls in self._tl_ids
         ]
 
+    def compile_topology(self, engine=None):
+        """
+        Count through an ObservationEngine (see engine.py). The observer builds one of its own, but observers of the
+        same network can share an engine (by passing it here before the first step), so that the vehicles are only
+        checked once a step. The lanes of the tree are views of the engine's arrays
+
+        @param engine: the ObservationEngine to add the lanes to. A new one by default
+        @return: the ObservationEngine
+        """
+        if self.mode == LANEAREA_MODE:
+            raise NotImplementedError("The lane-area detectors are counted by SUMO, there is nothing to compile")
+
+        from .engine import ObservationEngine
+
+        if engine is None:
+            engine = ObservationEngine()
+        engine.request(self.engine_features)
+        lanes = [(lane, tl._center) for tl in self.tls for lane in tl._lanes]
+        self._slots = engine.add_lanes(lanes, self._vehicle_key, self.lane_positions)
+        for (lane, _), slot in zip(lanes, self._slots.tolist()):
+            lane.view(engine, slot)
+        self._engine = engine
+        return engine
+
+    def _reset_state(self):
+        super()._reset_state()
+        if self._engine is not None:
+            self._engine.reset()
+
+    def _engine_values(self, sim_dict, feature: str) -> list:
+        return self._engine.update(sim_dict)[feature][self._slots].tolist()
+
     def get_counts(self, sim_dict) -> list:
         """
         update the counts for all lanes by passing the subscription updates
 
         @return: self.count_list
         """
+        if self._engine is not None:
+            return self._engine_values(sim_dict, "count")
 
-        # get a list of ids in each lane
-        # lane_ids = self.traci_c.lane.getAllSubscriptionResults()
-
-        # get the position of all vehicles in the network
-        # vehicle_positions = self.traci_c.vehicle.getAllSubscriptionResults()
-
-        # pass the lane_ids and vehicle_positions to the distance calculation
+        # lanearea mode, the lanes count with their detectors
         counts = []
-        # print("sim_counts", sim_dict[VAR_LANES])
         for child in self:
-            counts.extend(
-                child.update_counts(
-                    lane_info=sim_dict[VAR_LANES], vehicle_info=sim_dict[VAR_VEHICLE]
-                )
-            )
+            counts.extend(child.update_counts(detector_info=sim_dict[CMD_GET_LANEAREA_VARIABLE]))
 
         # return the pre-constructed count dictionary
         return counts
 
     def update(self, sim_dict) -> List:
         # This just renames get_counts to strictly update count, not get values
-        
-        # print("sim_counts", sim_dict[VAR_LANES])
+        if self._engine is not None:
+            self._engine.update(sim_dict)
+            return
         for child in self:
-            child.update_counts(
-                lane_info=sim_dict[VAR_LANES], vehicle_info=sim_dict[VAR_VEHICLE]
-            )
+            child.update_counts(detector_info=sim_dict[CMD_GET_LANEAREA_VARIABLE])
 
     def register_traci(self, traci_c: object) -> Tuple[Tuple[object, tuple, int]]:
         """
@@ -522,16 +797,76 @@ class GlobalObservations(_Base):
         @return:
         """
         # self.traci_c = traci_c
-        for child in self:
-            child.register_traci(traci_c)
+        if self.mode == LANEAREA_MODE:
+            # no lane or vehicle subscriptions at all
+            for detector_id in self._detectors:
+                traci_c.lanearea.subscribe(detector_id, DETECTOR_SUBSCRIPTIONS)
+            return ((traci_c.lanearea.getAllSubscriptionResults, (), CMD_GET_LANEAREA_VARIABLE), )
+
+        if self.mode == HYBRID_MODE:
+            self._subscribe_split_lanes(traci_c)
+        else:
+            for child in self:
+                child.register_traci(traci_c)
+
+        if self.mode in (CONTEXT_MODE, HYBRID_MODE):
+            for tl in self.tls:
+                traci_c.junction.subscribeContext(
+                    tl._tl_id, CMD_GET_VEHICLE_VARIABLE, DISTANCE_THRESHOLD + CONTEXT_MARGIN,
+                    [self._position_variable, *self.vehicle_variables]
+                )
+            return (
+                (traci_c.lane.getAllSubscriptionResults, (), VAR_LANES),
+                (self._get_context_vehicles, (traci_c, ), CONTEXT_VEHICLES),
+            )
 
         return (
             (traci_c.lane.getAllSubscriptionResults, (), VAR_LANES),
             (traci_c.vehicle.getAllSubscriptionResults, (), VAR_VEHICLE),
         )
 
+    def _subscribe_split_lanes(self, traci_c) -> None:
+        """
+        Subscribe to the vehicle ids of the lanes that are checked and the vehicle number of the lanes that aren't.
+        A SUMO lane can be both (for different traffic lights), and a second subscription replaces the first
+
+        @param traci_c:
+        @return: None
+        """
+        variables: Dict[str, List[int]] = {}
+        for tl in self.tls:
+            for lane in tl._lanes:
+                for l in lane.id_lanes:
+                    variables.setdefault(l, [])
+                    if LAST_STEP_VEHICLE_ID_LIST not in variables[l]:
+                        variables[l].append(LAST_STEP_VEHICLE_ID_LIST)
+                for l in lane.inside_lanes:
+                    variables.setdefault(l, [])
+                    for variable in (LAST_STEP_VEHICLE_NUMBER, *self.inside_lane_variables):
+                        if variable not in variables[l]:
+                            variables[l].append(variable)
+        for l, lane_variables in variables.items():
+            traci_c.lane.subscribe(l, lane_variables)
+
+    def _get_context_vehicles(self, traci_c) -> Dict[str, dict]:
+        """
+        The vehicles around all of the traffic lights, in one dictionary like traci.vehicle.getAllSubscriptionResults
+
+        @param traci_c:
+        @return: {ids: {VAR_POSITION: position}}
+        """
+        vehicles = {}
+        for tl_id in self._tl_ids:
+            vehicles.update(traci_c.junction.getContextSubscriptionResults(tl_id))
+        return vehicles
+
     @property
     def vehicle_subscriptions(
         self,
     ) -> List[int]:
-        return [VAR_POSITION]
+        """
+        The variables that the kernel has to subscribe to for every vehicle in the network
+
+        @return: a list of traci constants
+        """
+        return [self._position_variable, *self.vehicle_variables] if self.mode == VEHICLE_MODE else []
@@ -2,8 +2,11 @@ from collections import OrderedDict
 from enum import Enum
 from typing import Dict, Iterable, List, Tuple, Union
 
+import numpy as np
 import sumolib
-from rl_sumo.core.observers.observer import Approach, GlobalObservations, Lane, LaneType, TLObservations, read_net
+from rl_sumo.core.observers.observer import (
+    VEHICLE_MODE, Approach, GlobalObservations, Lane, LaneType, TLObservations, read_net
+)
 from rl_sumo.helpers.utils import read_nema_config
 
 
@@ -134,6 +137,8 @@ class PhaseTLObservations(TLObservations):
 
         self._clear_duplicate_lanes()
 
+        self._lanes: List[Lane] = [lane for child in self for lane in child]
+
     def _phase_factory(self, *args, **kwargs) -> Phase:
         return Phase(
                 camera_position=self._center,
@@ -159,19 +164,14 @@ class PhaseTLObservations(TLObservations):
             for phase_name, phase_info in nema_config_dict["phase"].items()
         ]
 
-    def update_counts(
-        self, **kwargs
-    ) -> List[List,]:
+    def collect(self, ):
         """
-        This function calls update_counts on the children and passes the center coordinates
+        The values of the lanes of every phase, a list per phase
 
-        @param kwargs: a forgiving list of inputs
-        @return: a list of lists
+        @return: self.count_list
         """
-        self.count_list.clear()
-        for child in self:
-            self.count_list.append(child.update_counts(center=self._center, **kwargs))
-        return self.count_list.copy()
+        self.count_list[:] = [child.collect() for child in self]
+        return self.count_list
 
     def get_values(self, param: str = 'counts', mapped_method: bool = False) -> Union[List[int], Dict[int, float]]:
         if mapped_method:
@@ -191,6 +191,8 @@ class GlobalPhaseObservations(GlobalObservations):
         net_file: str,
         nema_file_map: Dict[str, str],
         name: str,
+        mode: str = VEHICLE_MODE,
+        lane_positions: bool = False,
     ):
         """
         Instantiating the GlobalObservations class
@@ -198,15 +200,17 @@ class GlobalPhaseObservations(GlobalObservations):
         @param net_file: the net file path
         @param tl_ids: a list of traffic light ids
         @param name: the name of the object
-        @param traci_instance: the traci instance
+        @param mode: how the vehicle positions are subscribed to (one of OBSERVATION_MODES)
+        @param lane_positions: check the vehicles by their position along the lane instead of their x, y position
         """
         self._tl_ids = list(nema_file_map.keys())
+        self._set_mode(mode, lane_positions)
         # super(GlobalObservations, self).__init__()
+        net = read_net(net_file)
         super(GlobalObservations, self).__init__(
-            name, children=self._compose_tls(read_net(net_file), nema_file_map)
+            name, children=self._compose_tls(net, nema_file_map)
         )
-        # freeze all the initial values
-        self.freeze()
+        self._prepare_lanes(net)
 
     def _compose_tls(
         self, net_obj: sumolib.net.Net, nema_file_map: Dict[str, str]
@@ -226,3 +230,22 @@ class GlobalPhaseObservations(GlobalObservations):
             )
             for tls in self._tl_ids
         ]
+
+    def compile_topology(self, engine=None):
+        engine = super().compile_topology(engine)
+        # the slots of every phase, in the order of get_counts
+        sizes = [len(phase._children) for tl in self.tls for phase in tl]
+        ends = np.cumsum(sizes).tolist()
+        self._phase_slices = [slice(end - size, end) for size, end in zip(sizes, ends)]
+        return engine
+
+    def get_counts(self, sim_dict) -> list:
+        """
+        update the counts for all lanes by passing the subscription updates
+
+        @return: a list of the lane counts of every phase
+        """
+        if self._engine is None:
+            return super().get_counts(sim_dict)
+        counts = self._engine_values(sim_dict, "count")
+        return [counts[s] for s in self._phase_slices]
@@ -16,6 +16,9 @@ def minimize_fuel(subscription_values):
 
 
 class Rewarder:
+    # the variables that the kernel has to subscribe to for every vehicle in the network
+    vehicle_subscriptions = []
+
     def __init__(self, ):
         pass
 
@@ -30,6 +33,8 @@ class Rewarder:
 
 
 class PureFuelMin(Rewarder):
+    vehicle_subscriptions = [tc.VAR_FUELCONSUMPTION]
+
     def __init__(self, sim_params, *args, **kwargs):
         super(PureFuelMin, self).__init__()
         self.sim_step = deepcopy(sim_params.sim_step)
@@ -43,6 +48,10 @@ class PureFuelMin(Rewarder):
         # self.rho = 1.204  # kg/m^3
         self.normailizer = 10  # ml_s
 
+    def register_traci(self, traci_c):
+        # the observer doesn't get every vehicle in context mode
+        return [[traci_c.vehicle.getAllSubscriptionResults, (), tc.VAR_VEHICLE]]
+
     def get_reward(self, subscription_dict):
 
         vehicle_list = list(subscription_dict[tc.VAR_VEHICLE].values())
@@ -63,6 +72,10 @@ class FCIC(Rewarder):
 
     @return:
     """
+    # every vehicle in the network, like the 1000 km junction context around the central junction that this used to be.
+    # A per vehicle subscription of its own doesn't widen the observer's junction context there
+    vehicle_subscriptions = [tc.VAR_SPEED, tc.VAR_ALLOWED_SPEED, tc.VAR_ROAD_ID]
+
     def __init__(self, sim_params, *args, **kwargs):
         super(FCIC, self).__init__()
         self.junction_id = deepcopy(sim_params.central_junction)
@@ -88,9 +101,7 @@ class FCIC(Rewarder):
 
     def register_traci(self, traci_c):
         self._reward_array.clear()
-        traci_c.junction.subscribeContext(self.junction_id, tc.CMD_GET_VEHICLE_VARIABLE, 1000000,
-                                          [tc.VAR_SPEED, tc.VAR_ALLOWED_SPEED, tc.VAR_ROAD_ID])
-        return [[traci_c.junction.getContextSubscriptionResults, (self.junction_id, ), self.junction_id]]
+        return [[traci_c.vehicle.getAllSubscriptionResults, (), self.junction_id]]
 
     def get_reward(self, subscription_dict):
         relevant_data = subscription_dict[self.junction_id]
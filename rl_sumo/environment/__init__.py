@@ -1 +1,2 @@
 from .env import TLEnv
+from .dual_ring_env import TLDualRingEnv
@@ -0,0 +1,127 @@
+"""
+A version of TLEnv that controls SUMO's NEMA (dual ring) traffic lights and observes the per-phase pressure.
+
+The traffic light state, the phase names and the lane vehicles all arrive through subscriptions registered with the kernel,
+so a step doesn't make any synchronous traci getter calls. Use it with:
+
+    "environment_location": "rl_sumo.environment.dual_ring_env",
+    "environment_name": "TLDualRingEnv"
+
+and a "nema_file_map" ({<traffic-light-id>: <path to the NEMA additional file>}) in the Simulation settings.
+The NEMA files need to be in the "additional_files" as well.
+"""
+from typing import List
+
+import numpy as np
+from gym.spaces import Box, MultiDiscrete
+
+from rl_sumo.core.actors import GlobalDualRingActor
+from rl_sumo.core.observers import MaxPressureGlobalObservations
+from rl_sumo.environment.env import TLEnv
+
+# the number of light heads reported per traffic light, one per ring
+RING_NUM = 2
+
+
+class TLDualRingEnv(TLEnv):
+    def __init__(
+        self,
+        env_params,
+        sim_params,
+    ):
+        """
+        The observation is (active phase combination, active time, light head colors, per-phase pressure)
+
+        Args:
+            env_params: an instance of EnvParams class
+            sim_params: an instance of SimParams class
+        """
+        super().__init__(env_params, sim_params)
+
+        # the NEMA program is set by the actor, the kernel shouldn't switch to the "<tl_id>-2" program
+        self.k.rl_program_control = False
+
+    @property
+    def nema_file_map(self, ):
+        return self.sim_params['nema_file_map'] or self.sim_params['tl_file_dict']
+
+    def _create_observer(self, ):
+        return MaxPressureGlobalObservations(
+            net_file=self.sim_params.net_file,
+            nema_file_map=self.nema_file_map,
+            name="Global",
+            mode=self.env_params.observation_mode,
+            lane_positions=self.env_params.lane_position_cutoff,
+        )
+
+    def _create_actor(self, ):
+        return GlobalDualRingActor(
+            nema_file_map=self.nema_file_map,
+            network_file=self.sim_params.net_file,
+            subscription_method=True,
+        )
+
+    def _observation_components(self, ) -> tuple:
+        traffic_light_states = MultiDiscrete([*self.actor.discrete_space_shape])
+
+        traffic_light_times = Box(
+            low=0,
+            high=self.sim_params.sim_length,
+            shape=self._action_space.shape,
+            dtype=np.float32,
+        )
+
+        traffic_light_colors = MultiDiscrete([3] * RING_NUM * len(self.actor.tls))
+
+        # the pressure of a phase is the sum of its lane densities (incoming lanes positive, outgoing negative)
+        lane_nums = np.array([len(list(phase)) for tl in self.observer for phase in tl], dtype=np.float32)
+        phase_pressure = Box(low=-lane_nums, high=lane_nums, dtype=np.float32)
+
+        return traffic_light_states, traffic_light_times, traffic_light_colors, phase_pressure
+
+    def _compact_component(self, key: str, space) -> tuple:
+        if key == 'count':
+            # the pressure is a signed, fractional density
+            return Box(low=space.low.astype(np.float16), high=space.high.astype(np.float16), dtype=np.float16), None
+        return super()._compact_component(key, space)
+
+    def apply_rl_actions(self, rl_actions):
+        """
+        Convert the action indices to phase combinations and pass them to the dual ring actor
+        """
+        if rl_actions is None or self.sim_params.no_actor:
+            return
+
+        self.actor.update_lights([tl.action_space[int(a)] for a, tl in zip(rl_actions, self.actor)])
+
+    def _refresh_actor(self, subscription_data) -> None:
+        # SUMO switches the NEMA phases, so the actor only learns about it (and the start of the phases' minimum greens)
+        # from the subscription results
+        for tl in self.actor:
+            tl.get_sumo_state(self.k.sim_time, subscription_data)
+
+    def _observation_values(self, subscription_data) -> tuple:
+        # the actor reads the phase names and light strings from the subscription results
+        active_states, colors = self.actor.get_sumo_state(self.k.sim_time, subscription_data)
+
+        states: List[int] = []
+        times: List[float] = []
+        light_head_colors: List[int] = []
+        for tl, active_state, color in zip(self.actor, active_states, colors):
+            states.append(tl.action_space.index(active_state) if active_state in tl.action_space else 0)
+            times.append(min((tl.get_phase_active_time(p, self.k.sim_time) for p in active_state), default=0))
+            light_head_colors.extend((list(color) + [0] * RING_NUM)[:RING_NUM])
+
+        pressure = self.observer.get_phase_pressure(subscription_data)
+
+        return states, times, light_head_colors, pressure
+
+    def _subscribe_n_pass_traci(self, ):
+        self.k.add_traci_call(self.observer.register_traci(self.k.traci_c))
+
+        # the actor subscribes to its traffic lights and returns the call for the results
+        self.k.add_traci_call(self.actor.register_traci(self.k.traci_c))
+        self.actor.initialize_control(gracefully=False)
+
+        if reward_calls := self.rewarder.register_traci(self.k.traci_c):
+            self.k.add_traci_call(reward_calls)
@@ -1,20 +1,64 @@
 import gym
+import contextlib
+import os
 import sumolib
-import atexit
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
 import traci.exceptions
-from gym.spaces import Box, Tuple, Discrete, MultiDiscrete
+from gym.spaces import Box, Dict, Tuple, Discrete, MultiDiscrete
 from gym.utils import seeding
 import numpy as np
 import traceback
 from copy import deepcopy
 from math import floor
 from rl_sumo.core import Kernel
+from rl_sumo.core.health import SumoHealth
 from rl_sumo.core import GlobalObservations
 from rl_sumo.core.actors import GlobalActor
 from rl_sumo.core import rewarder
+from rl_sumo.helpers.transition_logger import TransitionLogger
+from rl_sumo.environment.history import ObservationHistory
+from rl_sumo.environment.normalizer import RunningNormalizer
 from abc import ABCMeta, abstractmethod
 
+# the components of the observation, in order
+OBSERVATION_KEYS = ('state', 'time', 'color', 'count')
+
+
+def _smallest_uint(high) -> type:
+    """
+    The smallest unsigned integer dtype (uint8 or uint16) that holds every value up to high
+    """
+    return np.uint8 if np.max(high) <= np.iinfo(np.uint8).max else np.uint16
+
+
+def _terminate(
+    kernel: Kernel, transition_logger: TransitionLogger, normalizer: RunningNormalizer, detector_file: str = None
+) -> None:
+    """
+    Close everything that TLEnv owns. A function (rather than a method) so that weakref.finalize doesn't reference the environment
+    """
+    if transition_logger is not None:
+        transition_logger.close()
+
+    if normalizer is not None:
+        # leave the latest statistics for evaluation
+        normalizer.sync()
+
+    try:
+        kernel.close_simulation()
+
+    except FileNotFoundError:
+        # Skip automatic termination. Connection is probably already closed
+        print(traceback.format_exc())
+
+    if detector_file is not None:
+        # SUMO is closed, so the generated lane-area detectors aren't needed anymore
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(detector_file)
+
 
 class TLEnv(gym.Env, metaclass=ABCMeta):
     def __init__(
@@ -49,25 +93,113 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
         # instantiate the kernel
         self.k = Kernel(self.sim_params)
 
+        # decides when the SUMO process has gotten too slow or too big and should be restarted
+        self.health = SumoHealth(
+            max_rss_mb=self.env_params.max_sumo_rss_mb,
+            max_latency_drift=self.env_params.max_step_latency_drift,
+            max_soft_reset_time=self.env_params.max_soft_reset_time,
+        )
+
         # create the observer
-        self.observer = GlobalObservations(net_file=sim_params.net_file, tl_ids=sim_params.tl_ids, name="Global")
+        self.observer = self._create_observer()
+        # the generated lane-area detector file, removed on close
+        self._detector_file: str = None
+        if self.env_params.observation_mode == "lanearea":
+            self._add_detector_file()
 
         # create the action space
-        self.actor = GlobalActor(tl_settings_file=sim_params.tl_settings_file, tl_file_dicts=sim_params['tl_file_dict'])
+        self.actor = self._create_actor()
 
         # create the reward function
         self.rewarder = getattr(rewarder, self.env_params.reward_class)(sim_params, env_params)
 
-        # terminate sumo on exit
-        atexit.register(self.terminate)
+        # only subscribe to the vehicle variables that the observer and the reward function use
+        self.k.vehicle_subscriptions = list(
+            dict.fromkeys(self.observer.vehicle_subscriptions + self.rewarder.vehicle_subscriptions)
+        )
+
+        # the spaces don't change, so build them once
+        self._history: ObservationHistory = None
+        self._normalizer: RunningNormalizer = None
+        # with compact_observation, {key: (dtype, quantum, low, high)} of every component
+        self._encodings: dict = None
+        self._action_space = self._build_action_space()
+        self._observation_space = self._build_observation_space()
+
+        # the flat observation is written into this buffer every step.
+        # If the consumer copies the observation anyway (like the vectorized environment), it can skip the copy on return
+        self._obs_buffer = np.zeros(self._observation_space.shape[-1:], dtype=self._observation_space.dtype) if self.env_params.flat_observation else None
+        self.reuse_observation_buffer = False
+
+        # with action masking, the observation is wrapped in a Dict alongside the valid actions
+        self._masked_observation_space = Dict({
+            "action_mask": Box(low=0, high=1, shape=(self._action_mask_size(), ), dtype=np.float32),
+            "observations": self._observation_space,
+        }) if self.env_params.action_mask else None
+
+        # optionally log the transitions for offline learning
+        self.transition_logger = TransitionLogger(
+            self.env_params.transition_log_dir, self.env_params.transition_log_chunk_size
+        ) if self.env_params.transition_log_dir else None
+
+        # SUMO is stepped on this thread in pipelined mode.
+        # The thread exits on its own when the executor is garbage collected with the environment
+        self._stepper = None
+        if self.env_params.pipelined_step:
+            self._stepper = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sumo-step")
+            self.k.copy_results = True
+
+        # terminate sumo on exit (or when the environment is garbage collected),
+        # without a process-wide atexit hook keeping every environment alive
+        weakref.finalize(self, _terminate, self.k, self.transition_logger, self._normalizer, self._detector_file)
 
     @property
     def action_space(self):
-        return MultiDiscrete([*self.actor.discrete_space_shape])
+        return self._action_space
 
     @property
     def observation_space(self):
+        return self._masked_observation_space if self._masked_observation_space is not None else self._observation_space
+
+    def _action_mask_size(self, ) -> int:
+        # RLlib concatenates the logits of a MultiDiscrete space, so the mask is concatenated too
+        if isinstance(self._action_space, MultiDiscrete):
+            return int(np.sum(self._action_space.nvec))
+        return self._action_space.n
+
+    def _create_observer(self, ):
+        return GlobalObservations(
+            net_file=self.sim_params.net_file,
+            tl_ids=self.sim_params.tl_ids,
+            name="Global",
+            mode=self.env_params.observation_mode,
+            lane_positions=self.env_params.lane_position_cutoff,
+        )
+
+    def _add_detector_file(self, ) -> None:
+        """
+        Write the observer's lane-area detectors to an additional file that SUMO is started with
+        """
+        path = os.path.join(self.sim_params.sim_state_dir, f"lanearea_detectors_{self.sim_params.port}.add.xml")
+        self.observer.write_detector_file(path)
+        self._detector_file = path
+        # the kernel has its own copy of the simulation parameters
+        for params in (self.sim_params, self.k.sim_params):
+            params.additional_files = params.additional_files + [path]
+
+    def _create_actor(self, ):
+        return GlobalActor(tl_settings_file=self.sim_params.tl_settings_file, tl_file_dicts=self.sim_params['tl_file_dict'])
+
+    def _build_action_space(self, ):
+        return MultiDiscrete([*self.actor.discrete_space_shape])
 
+    def _observation_components(self, ) -> tuple:
+        """
+        The spaces of the observation's components, in the order of OBSERVATION_KEYS
+
+        Returns:
+            tuple: (traffic light states, traffic light times, traffic light colors, vehicle numbers)
+        """
         traffic_light_states = MultiDiscrete([*self.actor.discrete_space_shape])
 
         traffic_light_colors = MultiDiscrete(self.actor.size['color'])
@@ -76,7 +208,7 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
             low=0,
             high=self.sim_params.sim_length,
             # the value is actually the time delta since the start of the last green state but theoretical max is sim length
-            shape=self.action_space.shape,
+            shape=self._action_space.shape,
             dtype=np.float32)
 
         vehicle_num = Box(
@@ -87,7 +219,94 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
             dtype=np.float32,
         )
 
-        return Tuple((traffic_light_states, traffic_light_times, traffic_light_colors, vehicle_num))
+        return traffic_light_states, traffic_light_times, traffic_light_colors, vehicle_num
+
+    def _time_encoding(self, high: float) -> tuple:
+        """
+        How the green times are stored with compact_observation
+
+        Args:
+            high (float): the largest time
+
+        Returns:
+            tuple: (dtype, quantum). The stored value is the time / quantum (rounded), None if the time is stored as is
+        """
+        if self.env_params.compact_observation == 'uint16':
+            # quantize to sim steps, or coarser if the simulation is too long to fit
+            return np.uint16, max(self.sim_params.sim_step, high / np.iinfo(np.uint16).max)
+        return np.float16, None
+
+    def _compact_component(self, key: str, space) -> tuple:
+        """
+        The compact version of one of the observation's components
+
+        Args:
+            key (str): the component's key in OBSERVATION_KEYS
+            space: the float32 (or int64) space of the component
+
+        Returns:
+            tuple: (compact space, quantum). See _time_encoding
+        """
+        if isinstance(space, MultiDiscrete):
+            return MultiDiscrete(space.nvec, dtype=_smallest_uint(space.nvec - 1)), None
+
+        if key == 'time':
+            dtype, quantum = self._time_encoding(float(np.max(space.high)))
+            if quantum is None:
+                return Box(low=space.low.astype(dtype), high=space.high.astype(dtype), dtype=dtype), None
+            return Box(low=0, high=np.ceil(space.high / quantum), dtype=dtype), quantum
+
+        # the lane counts are whole numbers of vehicles
+        return Box(low=space.low, high=space.high, dtype=_smallest_uint(space.high)), 1.
+
+    def _build_observation_space(self, ):
+
+        components = self._observation_components()
+
+        if self.env_params.compact_observation:
+            self._encodings = {}
+            compact_components = []
+            for key, space in zip(OBSERVATION_KEYS, components):
+                space, quantum = self._compact_component(key, space)
+                low, high = (0, space.nvec - 1) if isinstance(space, MultiDiscrete) else (space.low, space.high)
+                self._encodings[key] = (space.dtype, quantum, low, high)
+                compact_components.append(space)
+            components = tuple(compact_components)
+
+        if not self.env_params.flat_observation:
+            return Tuple(components)
+
+        # the flat observation is laid out as [states, green times, colors, lane counts]
+        self._obs_slices = {}
+        lows, highs = [], []
+        start = 0
+        for key, space in zip(OBSERVATION_KEYS, components):
+            low, high = (np.zeros_like(space.nvec), space.nvec - 1) if isinstance(space, MultiDiscrete) else (space.low, space.high)
+            self._obs_slices[key] = slice(start, start + len(low))
+            start += len(low)
+            lows.append(low)
+            highs.append(high)
+
+        # one Box has one dtype, so the flat observation takes the widest of the components
+        dtype = np.result_type(*(space.dtype for space in components)) if self._encodings else np.float32
+        if self.env_params.normalize_observation:
+            # the normalized values are floats
+            dtype = np.result_type(dtype, np.float16)
+
+        low, high = np.concatenate(lows).astype(dtype), np.concatenate(highs).astype(dtype)
+
+        if self.env_params.normalize_observation:
+            self._normalizer = RunningNormalizer(
+                len(low), sync_dir=self.env_params.normalizer_sync_dir, frozen=self.env_params.freeze_normalizer
+            )
+            low, high = np.full_like(low, -self._normalizer.clip), np.full_like(high, self._normalizer.clip)
+
+        if self.env_params.observation_history > 1:
+            # the last N observations are kept in a ring buffer and returned as a (N, observation size) stack
+            self._history = ObservationHistory(self.env_params.observation_history, len(low), dtype=dtype)
+            low, high = (np.tile(a, (self.env_params.observation_history, 1)) for a in (low, high))
+
+        return Box(low=low, high=high, dtype=dtype)
 
     def apply_rl_actions(self, rl_actions):
         """Specify the actions to be performed by the rl agent(s).
@@ -118,6 +337,46 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
         state : array_like, in the shape of self.action_space
         """
 
+        values = self._observation_values(subscription_data)
+
+        if self._encodings is not None:
+            values = tuple(self._encode(key, value) for key, value in zip(OBSERVATION_KEYS, values))
+
+        if self._obs_buffer is None:
+            return self._add_action_mask(values)
+
+        # write everything in place into the flat buffer
+        for key, value in zip(OBSERVATION_KEYS, values):
+            self._obs_buffer[self._obs_slices[key]] = value
+
+        if self._normalizer is not None:
+            self._normalizer.update(self._obs_buffer)
+            self._normalizer.normalize(self._obs_buffer)
+
+        observation = self._obs_buffer if self._history is None else self._history.push(self._obs_buffer)
+
+        return self._add_action_mask(observation if self.reuse_observation_buffer else observation.copy())
+
+    def _encode(self, key: str, value) -> np.ndarray:
+        """
+        Convert one of the observation's components to its compact dtype
+        """
+        dtype, quantum, low, high = self._encodings[key]
+        value = np.asarray(value, dtype=np.float32)
+        if quantum is not None:
+            value = np.rint(value / quantum)
+        # an integer dtype would wrap around instead of saturating
+        return np.clip(value, low, high).astype(dtype)
+
+    def _add_action_mask(self, observation):
+        if self._masked_observation_space is None:
+            return observation
+        return {"action_mask": self.actor.get_action_mask(self.k.sim_time).copy(), "observations": observation}
+
+    def _observation_values(self, subscription_data) -> tuple:
+        """
+        The values of the observation's components, in the order of OBSERVATION_KEYS
+        """
         # prompt the observer class to find all counts
         count_list = self.observer.get_counts(subscription_data)
 
@@ -126,6 +385,12 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
 
         return (*tl_states, count_list)
 
+    def _refresh_actor(self, subscription_data) -> None:
+        """
+        Update the actor's view of the traffic lights from the subscription results of a simulation step.
+        The TLEnv actor sets the lights itself and always knows their state, so there is nothing to do
+        """
+
     def clip_actions(self, rl_actions=None):
         """Clip the actions passed from the RL agent.
 
@@ -165,13 +430,27 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
         # reset the time counter
         # self.time_counter = 0
 
-        # restart completely if we should restart
-        if (self.step_counter > 1e6) or (self.master_reset_count < 1):
+        self.health.end_episode()
+
+        # move along the demand curriculum. A demand scale that hasn't been warmed up yet needs a fresh SUMO
+        demand_scale = self._scheduled_demand_scale()
+        if demand_scale != self.k.demand_scale:
+            # the step latency is only comparable at the same demand
+            self.health.restarted()
+        scale_is_warm = self.k.set_demand_scale(demand_scale)
+
+        # restart completely on the first reset, or if SUMO has become unhealthy.
+        # The restart loads the saved warm state rather than warming up again
+        if self.master_reset_count < 1 or not scale_is_warm:
             self._hard_reset()
+        elif self.health.restart_reason(self.k.sumo_pid):
+            self._hard_reset(from_snapshot=True)
         # # else reset the simulation
         else:
             try:
+                start = time.perf_counter()
                 self.k.reset_simulation()
+                self.health.record_soft_reset(time.perf_counter() - start)
                 self._reset_action_obs_rewarder()
                 self._subscribe_n_pass_traci()
             except Exception:
@@ -192,11 +471,34 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
         # reset the reward class
         self.rewarder.re_initialize()
 
-        return self.get_state(subscription_data)
+        if self._history is not None:
+            self._history.clear()
+
+        if self._normalizer is not None:
+            # share the statistics with the other workers once per episode
+            self._normalizer.sync()
+
+        observation = self.get_state(subscription_data)
+
+        if self.transition_logger is not None:
+            self.transition_logger.start_episode(observation)
+
+        return observation
+
+    def _scheduled_demand_scale(self, ) -> float:
+        """
+        The demand scale of the coming episode, according to the demand_scale_schedule
+
+        @return: the scale
+        """
+        scale = 1.
+        for episode, _scale in self.sim_params.demand_scale_schedule:
+            if self.master_reset_count >= episode:
+                scale = _scale
+        return scale
 
     def _subscribe_n_pass_traci(self, ):
         self.k.add_traci_call(self.observer.register_traci(self.k.traci_c))
-        self.observer.freeze()
 
         # pass traci to the actor
         self.actor.register_traci(self.k.traci_c)
@@ -206,15 +508,17 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
 
 
 
-    def _hard_reset(self):
+    def _hard_reset(self, from_snapshot: bool = False):
         """
         This function is called when SUMO needs to be tore down and rebuilt
 
+        @param from_snapshot: load the saved warm state instead of running the warm up again
         @return: None
         """
         self.step_counter = 0
         self.k.close_simulation()
-        traci_c = self.k.start_simulation()
+        traci_c = self.k.start_simulation(from_snapshot=from_snapshot)
+        self.health.restarted()
         self._reset_action_obs_rewarder()
         self.k.pass_traci_kernel(traci_c)
 
@@ -245,51 +549,90 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
             info (dict): contains auxiliary diagnostic information (helpful for debugging, and sometimes learning)
         """
 
-        sim_broke = False
-        crash = False
+        start_time = self.k.sim_time
+        reward = 0
 
-        for _ in range(self.env_params.sims_per_step):
+        # the next simulation step, if it is already running in the background
+        pending = None
 
-            # increment the step counter
-            self.step_counter += 1
+        # in semi-MDP mode, keep advancing the simulation until one of the traffic lights can actually accept a new phase
+        while True:
+            subscription_data, sim_broke, crash = pending.result() if pending is not None else self._advance(action)
 
-            # self.time_counter += self.sim_params.sim_step
+            done = (self.step_counter >= self.horizon) or crash or sim_broke
 
-            # apply the rl agent actions
-            self.apply_rl_actions(rl_actions=action)
+            if sim_broke:
+                break
 
-            # step the simulation
-            subscription_data = self.k.simulation_step()
+            if self.env_params.semi_mdp and not done:
+                # can_switch needs the traffic light states of this simulation step
+                self._refresh_actor(subscription_data)
 
-            # check to see if there was a failure
-            if not subscription_data:
-                sim_broke = True
-                break
+            last = done or not self.env_params.semi_mdp or self.actor.can_switch(self.k.sim_time)
 
-            # check for collisions and kill the simulation if so.
-            # TODO: Actually implement this
-            crash = self.k.check_collision()
+            # whether to continue doesn't depend on the reward, so in pipelined mode SUMO runs the next step while it is calculated
+            pending = self._stepper.submit(self._advance, action) if self._stepper is not None and not last else None
 
-            if crash:
-                print("There was a crash")
+            reward += self.calculate_reward(subscription_data)
+
+            if last:
                 break
-        
+
         if not sim_broke:
             observation = self.get_state(subscription_data)
-            reward = self.calculate_reward(subscription_data)
         else:
             observation = []
             reward = 1
 
-        done = (self.step_counter >= self.horizon) or crash or sim_broke
-
         info = {
             'sim_time': self.k.sim_time,
+            'elapsed_time': self.k.sim_time - start_time,
             'broken': sim_broke
         }
 
+        if self.transition_logger is not None:
+            self.transition_logger.add(action, observation, reward, done, info)
+
         return observation, reward, done, info
 
+    def _advance(self, action):
+        """
+        Run sims_per_step simulation steps, applying the action before each of them
+
+        Args:
+            action (object): an action provided by the agent
+
+        Returns:
+            subscription_data, sim_broke, crash
+        """
+        subscription_data = {}
+        for _ in range(self.env_params.sims_per_step):
+
+            # increment the step counter
+            self.step_counter += 1
+
+            # self.time_counter += self.sim_params.sim_step
+
+            # apply the rl agent actions
+            self.apply_rl_actions(rl_actions=action)
+
+            # step the simulation
+            start = time.perf_counter()
+            subscription_data = self.k.simulation_step()
+            self.health.record_step(time.perf_counter() - start)
+
+            # check to see if there was a failure
+            if not subscription_data:
+                return subscription_data, True, False
+
+            # check for collisions and kill the simulation if so.
+            # TODO: Actually implement this
+            if self.k.check_collision():
+                print("There was a crash")
+                return subscription_data, False, True
+
+        return subscription_data, False, False
+
     def calculate_reward(self, subscription_data) -> float:
         return self.rewarder.get_reward(subscription_data)
 
@@ -300,12 +643,7 @@ class TLEnv(gym.Env, metaclass=ABCMeta):
 
 
     def terminate(self, ):
-        try:
-            self.k.close_simulation()
-
-        except FileNotFoundError:
-            # Skip automatic termination. Connection is probably already closed
-            print(traceback.format_exc())
+        _terminate(self.k, self.transition_logger, self._normalizer, self._detector_file)
 
     def close(self):
         """
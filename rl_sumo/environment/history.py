@@ -0,0 +1,54 @@
+"""
+A ring buffer of the last N flat observations, returned as a (N, observation size) stack without copying.
+"""
+import numpy as np
+
+
+class ObservationHistory:
+    """
+    Every frame is written twice, at row i and at row i + N of a buffer with 2N rows.
+    That way the last N frames (oldest first) are always the contiguous rows [i + 1, i + 1 + N),
+    so the stack is a view of the buffer rather than a copy
+    """
+
+    def __init__(self, length: int, size: int, dtype=np.float32):
+        """
+        Args:
+            length (int): the number of frames in the stack (N)
+            size (int): the size of one flat observation
+            dtype (optional): Defaults to np.float32.
+        """
+        self.length = length
+        self._buffer = np.zeros((2 * length, size), dtype=dtype)
+        # the row that the last frame was written to
+        self._index = length - 1
+        # the first frame of an episode fills the whole history
+        self._empty = True
+
+    def clear(self, ) -> None:
+        """
+        Called at the start of an episode. The next frame is repeated N times
+        """
+        self._empty = True
+
+    def push(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Add a frame, dropping the oldest one
+
+        Returns:
+            np.ndarray: the (N, size) stack. A view that is overwritten by the next push
+        """
+        if self._empty:
+            self._buffer[:] = frame
+            self._index = self.length - 1
+            self._empty = False
+            return self.stack
+
+        self._index = (self._index + 1) % self.length
+        self._buffer[self._index] = frame
+        self._buffer[self._index + self.length] = frame
+        return self.stack
+
+    @property
+    def stack(self, ) -> np.ndarray:
+        return self._buffer[self._index + 1:self._index + 1 + self.length]
@@ -0,0 +1,188 @@
+"""
+A multi-agent version of TLEnv, where every traffic light is its own agent.
+
+All of the agents share one observation and action space, so that they can be mapped to a single (shared) policy
+and RLlib batches their inference together. With observation_history and normalize_observation every agent gets its own
+stack and its own statistics. Use it with:
+
+    "environment_location": "rl_sumo.environment.multi_agent_env",
+    "environment_name": "TLMultiAgentEnv",
+    "multi_agent": true
+"""
+from typing import Dict, List
+
+import numpy as np
+from gym.spaces import Box, Discrete
+from ray.rllib.env.multi_agent_env import MultiAgentEnv
+
+from rl_sumo.environment.env import TLEnv
+from rl_sumo.environment.history import ObservationHistory
+from rl_sumo.environment.normalizer import RunningNormalizer
+
+
+class TLMultiAgentEnv(TLEnv, MultiAgentEnv):
+    def __init__(
+        self,
+        env_params,
+        sim_params,
+    ):
+        """
+        Slices the GlobalObservations and the GlobalActor per traffic light.
+
+        Each agent observes [state, green time, color, lane counts], with the lane counts zero-padded
+        to the traffic light with the most lanes (the last N of them with observation_history)
+
+        Args:
+            env_params: an instance of EnvParams class
+            sim_params: an instance of SimParams class
+        """
+        super().__init__(env_params, sim_params)
+
+        # the agents, in the order of the actor
+        self.agent_ids: List[str] = [tl.tl_id for tl in self.actor]
+        self._agent_ids = set(self.agent_ids)
+
+        # the (start, stop) of each agent's lanes in the observer's flat count list
+        offsets = {}
+        start = 0
+        for tl_obs in self.observer.tls:
+            offsets[tl_obs.name] = (start, start + tl_obs.get_lane_count())
+            start += tl_obs.get_lane_count()
+        self._count_slices = [slice(*offsets[tl_id]) for tl_id in self.agent_ids]
+
+        # every agent's observation is a row of this buffer
+        self._agent_obs = np.zeros((len(self.agent_ids), self._observation_space.shape[-1]), dtype=self._observation_space.dtype)
+        # and every agent's action mask is a row of this one. Actions past a traffic light's own action space stay invalid
+        self._agent_masks = np.zeros((len(self.agent_ids), self._action_space.n), dtype=np.float32)
+
+        MultiAgentEnv.__init__(self)
+
+    def _build_action_space(self, ):
+        # the shared action space is the largest action space. Larger actions are ignored by smaller traffic lights
+        return Discrete(max(self.actor.discrete_space_shape))
+
+    def _build_observation_space(self, ):
+        max_lanes = max(tl_obs.get_lane_count() for tl_obs in self.observer.tls)
+
+        # with compact_observation, every column takes the dtype of the green time (the widest one)
+        dtype, self._time_quantum = np.float32, None
+        if self.env_params.compact_observation:
+            dtype, self._time_quantum = self._time_encoding(self.sim_params.sim_length)
+
+        max_time = self.sim_params.sim_length if self._time_quantum is None else np.ceil(self.sim_params.sim_length / self._time_quantum)
+
+        if self.env_params.normalize_observation:
+            # the normalized values are floats
+            dtype = np.result_type(dtype, np.float16)
+
+        high = np.array(
+            [
+                self._action_space.n - 1,
+                max_time,
+                2,
+                *[self.observer.distance_threshold] * max_lanes,
+            ],
+            dtype=np.float32,
+        ).astype(dtype)
+        low = np.zeros_like(high)
+
+        # the agents are the rows of a (agent_num, observation size) buffer. The normalizer and the history work on the
+        # flattened buffer, so every agent has statistics of its own and a stack of its own observations
+        agent_num = sum(1 for _ in self.actor)
+
+        if self.env_params.normalize_observation:
+            self._normalizer = RunningNormalizer(
+                agent_num * len(high), sync_dir=self.env_params.normalizer_sync_dir,
+                frozen=self.env_params.freeze_normalizer
+            )
+            low, high = np.full_like(low, -self._normalizer.clip), np.full_like(high, self._normalizer.clip)
+
+        if self.env_params.observation_history > 1:
+            self._history = ObservationHistory(self.env_params.observation_history, agent_num * len(high), dtype=dtype)
+            low, high = (np.tile(a, (self.env_params.observation_history, 1)) for a in (low, high))
+
+        return Box(low=low, high=high, dtype=dtype)
+
+    def apply_rl_actions(self, rl_actions: Dict[str, int]):
+        """
+        Convert the per-agent actions to the list that GlobalActor expects.
+
+        Actions outside of a traffic light's action space (or missing actions) keep the current state
+        """
+        if rl_actions is None:
+            return
+
+        actions = []
+        for tl in self.actor:
+            action = rl_actions.get(tl.tl_id, None)
+            actions.append(action if action is not None and action < tl.action_space_length else tl.get_current_state())
+
+        super().apply_rl_actions(actions)
+
+    def get_state(self, subscription_data) -> Dict[str, np.ndarray]:
+        """
+        Write every agent's observation into its row of the shared buffer
+
+        Returns
+        -------
+        Dict[str, np.ndarray]: {tl_id: observation}
+        """
+        count_list = self.observer.get_counts(subscription_data)
+
+        states, last_green_times, light_head_colors = self.actor.get_current_state()
+
+        self._agent_obs[:, 0] = states
+        self._agent_obs[:, 1] = last_green_times if self._time_quantum is None else np.rint(
+            np.asarray(last_green_times) / self._time_quantum
+        )
+        self._agent_obs[:, 2] = light_head_colors
+        for row, count_slice in zip(self._agent_obs, self._count_slices):
+            row[3:3 + count_slice.stop - count_slice.start] = count_list[count_slice]
+            # the padding is normalized in place too, so it is written every step
+            row[3 + count_slice.stop - count_slice.start:] = 0
+
+        obs = self._agent_obs
+        if self._normalizer is not None:
+            frame = obs.reshape(-1)
+            self._normalizer.update(frame)
+            self._normalizer.normalize(frame)
+
+        if self._history is not None:
+            # (N, agent_num * observation size) -> (agent_num, N, observation size)
+            obs = self._history.push(obs.reshape(-1)).reshape(self._history.length, len(self.agent_ids), -1).swapaxes(0, 1)
+
+        if self._masked_observation_space is not None:
+            for row, tl in zip(self._agent_masks, self.actor):
+                tl.action_mask(self.k.sim_time, row[:tl.action_space_length])
+
+        return self._split(obs)
+
+    def _split(self, obs: np.ndarray) -> Dict[str, np.ndarray]:
+        # RLlib keeps the observations, so copy the buffer once and hand out views of the copy
+        obs = obs.copy()
+        if self._masked_observation_space is None:
+            return dict(zip(self.agent_ids, obs))
+        masks = self._agent_masks.copy()
+        return {
+            agent_id: {"action_mask": mask, "observations": o} for agent_id, o, mask in zip(self.agent_ids, obs, masks)
+        }
+
+    def step(self, action_dict: Dict[str, int]):
+        """
+        See TLEnv.step. The (global) reward is shared by all of the agents
+
+        Returns:
+            observation, reward, done, info dictionaries keyed by agent id
+        """
+        observation, reward, done, info = super().step(action_dict)
+
+        if not len(observation):
+            # the simulation broke
+            observation = self._split(np.zeros((len(self.agent_ids), *self._observation_space.shape), dtype=self._observation_space.dtype))
+
+        rewards = {tl_id: reward for tl_id in self.agent_ids}
+        dones = {tl_id: done for tl_id in self.agent_ids}
+        dones['__all__'] = done
+        infos = {tl_id: info for tl_id in self.agent_ids}
+
+        return observation, rewards, dones, infos
@@ -0,0 +1,129 @@
+"""
+A streaming (Welford) mean and variance normalizer for the flat observation.
+
+Every environment keeps the statistics of the observations that it has seen itself.
+If a sync directory is given, every environment writes its statistics there on sync and normalizes with the merge of all
+of the files (from all of the RLlib workers), which replaces RLlib's MeanStdFilter and its synchronization.
+For evaluation the normalizer is frozen: it reads the statistics once and never updates them.
+The files of an earlier run would be merged too, so the trainers clear the directory (clear_sync_dir) before training.
+"""
+import glob
+import os
+import uuid
+
+import numpy as np
+
+_FILE_PATTERN = "normalizer_*.npz"
+
+
+def clear_sync_dir(sync_dir: str) -> None:
+    """
+    Remove the statistics of earlier runs from a sync directory
+
+    Args:
+        sync_dir (str): the directory that the environments exchange their statistics through
+    """
+    for path in glob.glob(os.path.join(sync_dir, _FILE_PATTERN)):
+        os.remove(path)
+
+
+class RunningNormalizer:
+    def __init__(self, size: int, clip: float = 5., sync_dir: str = None, frozen: bool = False, epsilon: float = 1e-8):
+        """
+        Args:
+            size (int): the size of the flat observation
+            clip (float, optional): the normalized values are clipped to [-clip, clip]. Defaults to 5.
+            sync_dir (str, optional): the directory to exchange the statistics through. Defaults to None.
+            frozen (bool, optional): don't update the statistics. Needs a sync_dir to read them from. Defaults to False.
+            epsilon (float, optional): added to the variance. Defaults to 1e-8.
+        """
+        if frozen and sync_dir is None:
+            # it would normalize with mean 0 and std 1, not with the statistics of training
+            raise ValueError("A frozen normalizer needs a sync_dir to read the statistics from")
+
+        self.clip = clip
+        self.sync_dir = sync_dir
+        self.frozen = frozen
+        self._epsilon = epsilon
+
+        # the statistics of the observations that this environment has seen
+        self._count = 0
+        self._mean = np.zeros(size, dtype=np.float64)
+        self._m2 = np.zeros(size, dtype=np.float64)
+        self._delta = np.zeros(size, dtype=np.float64)
+
+        # what is actually used to normalize
+        self.mean = np.zeros(size, dtype=np.float32)
+        self.std = np.ones(size, dtype=np.float32)
+
+        if sync_dir is not None:
+            os.makedirs(sync_dir, exist_ok=True)
+            self._file = os.path.join(sync_dir, f"normalizer_{os.getpid()}_{uuid.uuid4().hex[:8]}.npz")
+            if frozen:
+                self.sync()
+
+    def update(self, x: np.ndarray) -> None:
+        """
+        Add an observation to the statistics (in place, Welford's algorithm)
+        """
+        if self.frozen:
+            return
+        self._count += 1
+        np.subtract(x, self._mean, out=self._delta)
+        self._mean += self._delta / self._count
+        # M2 += delta * (x - new mean)
+        self._m2 += self._delta * (x - self._mean)
+
+        if self.sync_dir is None:
+            # nothing to merge with, so use the statistics right away
+            self._set(self._count, self._mean, self._m2)
+
+    def normalize(self, x: np.ndarray) -> np.ndarray:
+        """
+        Normalize x in place
+
+        Returns:
+            np.ndarray: x
+        """
+        x -= self.mean
+        x /= self.std
+        return np.clip(x, -self.clip, self.clip, out=x)
+
+    def _set(self, count: int, mean: np.ndarray, m2: np.ndarray) -> None:
+        if count < 2:
+            return
+        self.mean[:] = mean
+        np.sqrt(m2 / count + self._epsilon, out=self.std, casting="unsafe")
+
+    def sync(self, ) -> None:
+        """
+        Write this environment's statistics to the sync directory and normalize with the merge of all of the files
+        """
+        if self.sync_dir is None:
+            return
+
+        if not self.frozen and self._count:
+            # write and then rename, so that the other workers never read a partial file
+            tmp_file = self._file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                np.savez(f, count=self._count, mean=self._mean, m2=self._m2)
+            os.replace(tmp_file, self._file)
+
+        count, mean, m2 = 0, np.zeros_like(self._mean), np.zeros_like(self._m2)
+        for path in glob.glob(os.path.join(self.sync_dir, _FILE_PATTERN)):
+            try:
+                with np.load(path) as stats:
+                    other_count, other_mean, other_m2 = int(stats["count"]), stats["mean"], stats["m2"]
+            except (OSError, ValueError, KeyError):
+                # a file from an incompatible run or a file that is being replaced
+                continue
+            if not other_count or other_mean.shape != mean.shape:
+                continue
+            # Chan et al.'s parallel merge
+            total = count + other_count
+            delta = other_mean - mean
+            mean = mean + delta * other_count / total
+            m2 = m2 + other_m2 + delta ** 2 * count * other_count / total
+            count = total
+
+        self._set(count, mean, m2)
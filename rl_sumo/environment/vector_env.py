@@ -0,0 +1,275 @@
+"""
+A vectorized version of the TLEnv that runs one SUMO + TLEnv per subprocess.
+
+Observations, rewards and dones are written by the subprocesses into shared memory,
+so only the (tiny) info dictionaries are pickled between the processes.
+It plugs into RLlib as a VectorEnv, meaning that a single policy forward pass serves all of the simulations on a worker.
+"""
+import multiprocessing as mp
+import traceback
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Tuple
+
+import numpy as np
+from gym.spaces import Box, Space, flatten, flatten_space
+from ray.rllib.env.vector_env import VectorEnv
+
+# the commands that can be sent to the subprocesses
+_RESET = "reset"
+_STEP = "step"
+_CLOSE = "close"
+
+
+class WorkerError(RuntimeError):
+    """
+    One of the subprocesses failed (the traceback is sent back over the pipe) or died
+    """
+
+
+class _SharedArray:
+    """
+    A numpy array that lives in a shared memory block
+    """
+
+    def __init__(self, shape: tuple, dtype, name: str = None):
+        """
+        Create (or attach to if name is passed) a shared numpy array
+
+        Args:
+            shape (tuple): the shape of the array
+            dtype: the numpy dtype of the array
+            name (str, optional): the name of an existing shared memory block. Defaults to None.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._owner = name is None
+        self._shm = (
+            SharedMemory(create=True, size=max(int(np.prod(self.shape)) * self.dtype.itemsize, 1))
+            if self._owner
+            else SharedMemory(name=name)
+        )
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        if self._owner:
+            self.array.fill(0)
+
+    @property
+    def spec(self) -> Tuple[str, tuple, str]:
+        """
+        What the subprocess needs to attach to the array
+        """
+        return self._shm.name, self.shape, self.dtype.str
+
+    def close(self) -> None:
+        # drop the reference to the buffer before closing, otherwise the memory can't be released
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _write_observation(space: Space, observation, out: np.ndarray) -> None:
+    """
+    Write an observation into a row of the shared observation array
+
+    Args:
+        space (Space): the observation space of the un-vectorized environment
+        observation: the observation returned by the environment
+        out (np.ndarray): the row to write into
+    """
+    if not len(observation):
+        # the simulation broke and an empty observation was returned
+        out.fill(0)
+    elif isinstance(space, Box):
+        out[:] = np.reshape(observation, -1)
+    else:
+        # gym's flatten expects arrays, TLEnv.get_state returns a tuple of lists
+        out[:] = flatten(space, tuple(np.asarray(o) for o in observation))
+
+
+def _worker(conn, index: int, env_params, sim_params) -> None:
+    """
+    The subprocess loop. Creates the environment and then waits for commands from the parent
+
+    Args:
+        conn: the child end of a multiprocessing Pipe
+        index (int): the row of the shared arrays that this environment owns
+        env_params: EnvParams class
+        sim_params: SimParams class
+    """
+    # imported here to avoid a circular import
+    from rl_sumo.helpers.register_environment import make_create_env
+
+    env = None
+    shared = []
+    try:
+        _, create_env = make_create_env(env_params, sim_params)
+        env = create_env()
+        # the observation is copied into shared memory, so a flat observation buffer doesn't need to be copied again
+        env.unwrapped.reuse_observation_buffer = True
+
+        conn.send((env.observation_space, env.action_space))
+
+        # attach to the shared arrays that the parent created
+        shared = [_SharedArray(shape, dtype, name) for name, shape, dtype in conn.recv()]
+        obs, rewards, dones, actions = shared
+
+        while True:
+            cmd = conn.recv()
+            if cmd == _STEP:
+                observation, reward, done, info = env.step(actions.array[index])
+                _write_observation(env.observation_space, observation, obs.array[index])
+                rewards.array[index] = reward
+                dones.array[index] = done
+                conn.send(info)
+            elif cmd == _RESET:
+                _write_observation(env.observation_space, env.reset(), obs.array[index])
+                dones.array[index] = False
+                conn.send(None)
+            elif cmd == _CLOSE:
+                break
+    except (EOFError, BrokenPipeError):
+        # the parent is gone
+        pass
+    except Exception:
+        # hand the error to the parent, which raises it instead of waiting for an answer
+        try:
+            conn.send(WorkerError(f"vector environment worker {index} failed:\n{traceback.format_exc()}"))
+        except (BrokenPipeError, OSError):
+            pass
+    finally:
+        if env is not None:
+            env.close()
+        for s in shared:
+            s.close()
+        conn.close()
+
+
+def _shutdown(conns: list, procs: list, shared: list) -> None:
+    """
+    Close the subprocesses and release the shared memory. Registered with weakref.finalize
+    """
+    for conn in conns:
+        try:
+            conn.send(_CLOSE)
+        except (BrokenPipeError, OSError):
+            pass
+    for proc in procs:
+        proc.join(timeout=10)
+        if proc.is_alive():
+            proc.terminate()
+    for s in shared:
+        s.close()
+
+
+class SharedMemoryVectorEnv(VectorEnv):
+    """
+    Runs K environments in subprocesses and exposes them to RLlib as a single VectorEnv.
+
+    The observation space is the flattened (Box) version of the environment's observation space.
+    """
+
+    def __init__(self, env_params, sim_params, num_envs: int):
+        """
+        Start the subprocesses and create the shared memory
+
+        Args:
+            env_params: EnvParams class
+            sim_params: SimParams class
+            num_envs (int): the number of environments (and SUMO instances) to run
+        """
+        # traci and SUMO don't like being forked
+        ctx = mp.get_context("spawn")
+
+        self._conns = []
+        self._procs = []
+        for i in range(num_envs):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_worker, args=(child_conn, i, env_params, sim_params), daemon=True)
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+
+        try:
+            spaces = [self._recv(i) for i in range(num_envs)]
+        except WorkerError:
+            _shutdown(self._conns, self._procs, [])
+            raise
+        # all the environments are the same, so only the first set of spaces is used
+        observation_space, action_space = spaces[0]
+        flat_space = flatten_space(observation_space)
+        # keep the (compact) dtype of a flat observation, a Tuple is flattened to float32 like RLlib does
+        obs_dtype = observation_space.dtype if isinstance(observation_space, Box) else np.float32
+
+        self._obs = _SharedArray((num_envs, *flat_space.shape), obs_dtype)
+        self._rewards = _SharedArray((num_envs, ), np.float64)
+        self._dones = _SharedArray((num_envs, ), np.bool_)
+        self._actions = _SharedArray((num_envs, *action_space.shape), action_space.dtype)
+
+        specs = [s.spec for s in (self._obs, self._rewards, self._dones, self._actions)]
+        for i in range(num_envs):
+            self._send(i, specs)
+
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self._conns, self._procs, [self._obs, self._rewards, self._dones, self._actions]
+        )
+
+        super().__init__(
+            observation_space=Box(low=flat_space.low, high=flat_space.high, dtype=obs_dtype),
+            action_space=action_space,
+            num_envs=num_envs,
+        )
+
+    def _send(self, index: int, message) -> None:
+        try:
+            self._conns[index].send(message)
+        except (BrokenPipeError, OSError) as e:
+            raise self._died(index) from e
+
+    def _recv(self, index: int):
+        """
+        The answer of a subprocess. Raises a WorkerError if the subprocess failed or died instead of answering
+        """
+        try:
+            message = self._conns[index].recv()
+        except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+            raise self._died(index) from e
+        if isinstance(message, WorkerError):
+            raise message
+        return message
+
+    def _died(self, index: int) -> WorkerError:
+        self._procs[index].join(timeout=1)
+        return WorkerError(f"vector environment worker {index} died (exit code {self._procs[index].exitcode})")
+
+    def _observations(self, ) -> List[np.ndarray]:
+        # RLlib holds on to the observations, so hand out a single copy of the shared array rather than views of it
+        return list(self._obs.array.copy())
+
+    def vector_reset(self, ) -> List[np.ndarray]:
+        for i in range(self.num_envs):
+            self._send(i, _RESET)
+        for i in range(self.num_envs):
+            self._recv(i)
+        return self._observations()
+
+    def reset_at(self, index: int = None) -> np.ndarray:
+        index = index or 0
+        self._send(index, _RESET)
+        self._recv(index)
+        return self._obs.array[index].copy()
+
+    def vector_step(self, actions: list) -> Tuple[list, list, list, list]:
+        self._actions.array[:] = actions
+        for i in range(self.num_envs):
+            self._send(i, _STEP)
+        infos = [self._recv(i) for i in range(self.num_envs)]
+        return self._observations(), self._rewards.array.tolist(), self._dones.array.tolist(), infos
+
+    def get_sub_environments(self, ) -> list:
+        # the environments live in the subprocesses
+        return []
+
+    def close(self, ) -> None:
+        self._finalizer()
@@ -53,7 +53,32 @@ def make_create_env(env_params, sim_params, version=0) -> Union[str, object]:
             )
 
             _env = gym.envs.make(env_name)
-        
-        return _env
+
+        # RLlib has to see the MultiAgentEnv itself, not the gym wrappers around it
+        return _env.unwrapped if env_params.multi_agent else _env
+
+    return env_name, create_env
+
+
+def make_create_vector_env(env_params, sim_params) -> Union[str, object]:
+    """
+    This function makes a create_env() function that returns a SharedMemoryVectorEnv,
+    running env_params.num_envs_per_worker copies of the environment in subprocesses
+
+    Args:
+        env_params: EnvParams class
+        sim_params: SimParams class
+
+    Returns:
+        fn: a create_env() function
+    """
+
+    env_name = f"{env_params.environment_name}-vec{env_params.num_envs_per_worker}"
+
+    def create_env(*_):
+        # ray is only needed when the vectorized environment is requested
+        from rl_sumo.environment.vector_env import SharedMemoryVectorEnv
+
+        return SharedMemoryVectorEnv(env_params, sim_params, num_envs=env_params.num_envs_per_worker)
 
     return env_name, create_env
@@ -0,0 +1,158 @@
+"""
+Logs the (observation, action, reward, done, info) transitions of an environment to compressed, columnar .npz shards.
+
+The shards are written by a background thread, so the step loop only pays for copying the transition into a python list.
+Every shard has the columns:
+
+    episode, step, observation, action, reward, next_observation, done, info/<key> (one per numeric info key)
+
+and can be loaded (and concatenated) with numpy alone:
+
+    data = [np.load(f) for f in sorted(glob.glob(os.path.join(log_dir, "*.npz")))]
+"""
+import os
+import queue
+import threading
+import uuid
+from typing import Dict, List
+
+import numpy as np
+
+# the default number of transitions per shard
+CHUNK_SIZE = 10000
+
+# tells the writer thread to stop
+_STOP = None
+
+
+def _to_array(value) -> np.ndarray:
+    """
+    Flatten an observation or action into a (new) numpy array.
+
+    Tuples of components and action masked observations ({"action_mask", "observations"}) are concatenated,
+    dictionaries of agents (multi-agent) are stacked in key order
+    """
+    if isinstance(value, dict):
+        arrays = [_to_array(v) for v in value.values()]
+        return np.concatenate(arrays) if "observations" in value else np.stack(arrays)
+    if isinstance(value, (tuple, list)) and len(value) and not np.isscalar(value[0]):
+        return np.concatenate([np.asarray(v, dtype=np.float32).reshape(-1) for v in value])
+    return np.array(value, dtype=np.float32).reshape(-1)
+
+
+class TransitionLogger:
+    """
+    Buffers transitions in memory and hands every full chunk to a writer thread
+    """
+
+    def __init__(self, log_dir: str, chunk_size: int = CHUNK_SIZE):
+        """
+        Args:
+            log_dir (str): the directory to write the shards to. It is created if it doesn't exist
+            chunk_size (int, optional): the number of transitions per shard. Defaults to CHUNK_SIZE.
+        """
+        os.makedirs(log_dir, exist_ok=True)
+
+        self.log_dir = log_dir
+        self.chunk_size = chunk_size
+
+        # several environments (RLlib workers, vectorized environments) can write to the same directory
+        self._prefix = f"transitions_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        self._shard_num = 0
+
+        self._episode = -1
+        self._step = 0
+        self._last_observation: np.ndarray = None
+
+        self._rows: Dict[str, List] = self._empty_rows()
+
+        self._queue: queue.Queue = queue.Queue()
+        # started with the first shard (and again if the environment is used after close)
+        self._writer: threading.Thread = None
+
+    @staticmethod
+    def _empty_rows() -> Dict[str, List]:
+        return {
+            "episode": [],
+            "step": [],
+            "observation": [],
+            "action": [],
+            "reward": [],
+            "next_observation": [],
+            "done": [],
+        }
+
+    def start_episode(self, observation) -> None:
+        """
+        Called on reset with the initial observation
+
+        Args:
+            observation: the observation returned by reset()
+        """
+        self._episode += 1
+        self._step = 0
+        self._last_observation = _to_array(observation)
+
+    def add(self, action, observation, reward: float, done: bool, info: dict) -> None:
+        """
+        Record a transition. The observation is the one returned by step()
+
+        Args:
+            action: the action passed to step()
+            observation: the resulting observation
+            reward (float): the reward
+            done (bool): whether the episode is done
+            info (dict): the info dictionary. Only the numeric values are recorded
+        """
+        # a broken simulation returns an empty observation
+        next_observation = _to_array(observation) if len(observation) else np.zeros_like(self._last_observation)
+
+        self._rows["episode"].append(self._episode)
+        self._rows["step"].append(self._step)
+        self._rows["observation"].append(self._last_observation)
+        self._rows["action"].append(_to_array(action))
+        self._rows["reward"].append(reward)
+        self._rows["next_observation"].append(next_observation)
+        self._rows["done"].append(done)
+        for key, value in info.items():
+            if isinstance(value, (bool, int, float, np.number)):
+                self._rows.setdefault(f"info/{key}", []).append(value)
+
+        self._last_observation = next_observation
+        self._step += 1
+
+        if len(self._rows["step"]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self, ) -> None:
+        """
+        Hand the buffered transitions to the writer thread
+        """
+        if not self._rows["step"]:
+            return
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+        self._queue.put((os.path.join(self.log_dir, f"{self._prefix}_{self._shard_num:05d}.npz"), self._rows))
+        self._shard_num += 1
+        self._rows = self._empty_rows()
+
+    def _write_loop(self, ) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            path, rows = item
+            # the columns are only stacked here, off of the step loop
+            np.savez_compressed(path, **{key: np.stack(values) for key, values in rows.items()})
+
+    def close(self, ) -> None:
+        """
+        Write the remaining transitions and wait for the writer thread to finish
+        """
+        self.flush()
+        if self._writer is None:
+            return
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._writer = None
@@ -66,6 +66,9 @@ def read_nema_config(path: str, tlsID: str = "") -> OrderedDict:
         assert(len(tlsID))
         tl_dict = [o for o in tl_dict if o['@programID'] == tlsID][0]
 
+    if 'param' not in tl_dict:
+        raise ValueError(f"{path} doesn't describe a NEMA traffic light, it has no <param> entries (ring1, ring2, ...)")
+
     # turn all the "params" into a unique dictionary with the key being the "Key" and "Value" being the "value"
     tl_dict['param'] = {
         p["@key"] : p["@value"] for p in tl_dict['param']
@@ -82,6 +82,81 @@ class EnvParams(object):
 
         self.cpu_num: int = safe_getter(params, 'cpu_num') or 1
 
+        # the number of simulations run (in subprocesses) by each RLlib worker. Only used by PPO
+        self.num_envs_per_worker: int = safe_getter(params, 'num_envs_per_worker') or 1
+
+        # return the observation as one flat Box instead of a Tuple
+        self.flat_observation: bool = safe_getter(params, 'flat_observation') or False
+
+        # stack the last N flat observations (N x observation size, per agent with multi_agent). Implies flat_observation
+        self.observation_history: int = safe_getter(params, 'observation_history') or 1
+
+        # normalize the flat observation with running (Welford) statistics, kept per agent with multi_agent.
+        # Implies flat_observation
+        self.normalize_observation: bool = safe_getter(params, 'normalize_observation') or False
+
+        # a directory that the environments exchange their normalization statistics through. Shared by all workers.
+        # Required with normalize_observation, it is also where evaluation reads the statistics of training from
+        self.normalizer_sync_dir: str = safe_getter(params, 'normalizer_sync_dir') or None
+        if self.normalize_observation and self.normalizer_sync_dir is None:
+            raise ValueError("normalize_observation needs a normalizer_sync_dir")
+
+        # don't update the normalization statistics, just read them from normalizer_sync_dir (for evaluation)
+        self.freeze_normalizer: bool = safe_getter(params, 'freeze_normalizer') or False
+
+        # store the observation in compact dtypes: uint8 (or uint16) traffic light states, colors and lane counts, and the
+        # green times as "float16" or as "uint16" quantized to sim steps. None keeps everything float32.
+        # Implies flat_observation
+        self.compact_observation: str = safe_getter(params, 'compact_observation') or None
+
+        # how the observer gets the vehicle positions. "vehicle" subscribes to every vehicle in the network,
+        # "context" to a junction context per traffic light, so that SUMO only sends the vehicles around it.
+        # "lanearea" counts the vehicles with lane-area detectors that are generated for the camera's view
+        # and "hybrid" only checks the vehicles on the lanes that cross the camera's radius and lets SUMO count the rest
+        self.observation_mode: str = safe_getter(params, 'observation_mode') or "vehicle"
+
+        # check the vehicles by their position along the lane (VAR_LANEPOSITION) against the stretch of every lane that the
+        # camera sees, which is worked out once from the lane shapes, instead of their distance to the camera
+        self.lane_position_cutoff: bool = safe_getter(params, 'lane_position_cutoff') or False
+
+        # only return to the agent when at least one traffic light can accept a new phase (semi-MDP)
+        self.semi_mdp: bool = safe_getter(params, 'semi_mdp') or False
+
+        # in the semi-MDP loop, run the next SUMO step on a background thread while the reward of the last one is calculated
+        self.pipelined_step: bool = safe_getter(params, 'pipelined_step') or False
+
+        # the environment is a MultiAgentEnv with one agent per traffic light, all mapped to a shared policy
+        self.multi_agent: bool = safe_getter(params, 'multi_agent') or False
+
+        # return a Dict observation {"action_mask", "observations"} that marks the actions that will take effect.
+        # Implies flat_observation, which the RLlib action mask model needs
+        self.action_mask: bool = safe_getter(params, 'action_mask') or False
+
+        # the shared memory vector env hands RLlib a single flat Box, which has no room for the mask
+        if self.action_mask and self.num_envs_per_worker > 1 and not self.multi_agent:
+            raise ValueError("action_mask can't be combined with num_envs_per_worker > 1")
+
+        self.flat_observation = (
+            self.flat_observation or self.observation_history > 1 or self.normalize_observation or self.action_mask
+            # RLlib's Tuple preprocessor would convert a compact Tuple back to float32
+            or bool(self.compact_observation)
+        )
+
+        # stream every transition to compressed .npz shards in this directory (for offline RL). Off if None
+        self.transition_log_dir: str = safe_getter(params, 'transition_log_dir') or None
+
+        # the number of transitions in each shard
+        self.transition_log_chunk_size: int = safe_getter(params, 'transition_log_chunk_size') or 10000
+
+        # restart SUMO (from the saved warm state) when its memory use in MB goes above this
+        self.max_sumo_rss_mb: float = safe_getter(params, 'max_sumo_rss_mb') or 4096
+
+        # restart SUMO when an episode's mean step time is this many times that of the first episode after the last restart
+        self.max_step_latency_drift: float = safe_getter(params, 'max_step_latency_drift') or 2.
+
+        # restart SUMO when a soft reset (loading the saved state) takes longer than this, in seconds
+        self.max_soft_reset_time: float = safe_getter(params, 'max_soft_reset_time') or 10.
+
         # pass the remaining items in the json input as parameters too
         for key, value in params.items():
             self.__dict__[key] = value
@@ -145,6 +220,10 @@ class SimParams(object):
         # sum the warmup time, sims per step * horizon and an extra 1000
         self.sim_length: int = env_params.warm_up_time + (env_params.sims_per_step * env_params.horizon) + 1000
 
+        # a demand curriculum like [[<episode>, <scale>], ...]. From <episode> on, the route demand is scaled by <scale>
+        # (SUMO's --scale). Episodes before the first entry and runs without a schedule use the calibrated demand
+        self.demand_scale_schedule: List[List[float]] = sorted(safe_getter(params, 'demand_scale_schedule') or [])
+
         # determine if the actor is desired or not
         # using this for offline analysis of the reward
         self.no_actor = safe_getter(params, "no_actor") or False
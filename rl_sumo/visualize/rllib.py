@@ -26,7 +26,7 @@ from rl_sumo.helpers.post_processing import xml2csv
 from rl_sumo.helpers.utils import get_parameters
 
 
-def get_config(result_dir, emissions_output, gui_config_file, tls_record_file):
+def get_config(result_dir, emissions_output, gui_config_file, tls_record_file, transition_log_dir=None):
     """Generates the configuration
 
     Args:
@@ -58,6 +58,16 @@ def get_config(result_dir, emissions_output, gui_config_file, tls_record_file):
     if tls_record_file:
         setattr(sim_params, 'tls_record_file', tls_record_file)
 
+    # replay with the calibrated demand, not a training curriculum
+    sim_params.demand_scale_schedule = []
+
+    # evaluate with the normalization statistics from training
+    env_params.freeze_normalizer = True
+
+    if transition_log_dir:
+        # record the replayed transitions for offline learning
+        env_params.transition_log_dir = transition_log_dir
+
 
     # HACK: for old environment names
     if 'my_gym' in env_params.environment_location:
@@ -162,7 +172,12 @@ def run_simulation(agent, env, multiagent, config, env_params, use_lstm, state_i
               type=str,
               help='An additional file to record traffic light states',
               default=None)
-def _visualizer_rllib(result_dir, checkpoints, emissions_output, horizon, video_dir, gui_config_file, tls_record_file):
+@click.option('--transition_log_dir',
+              type=str,
+              help='A directory to log the (observation, action, reward, done, info) transitions to',
+              default=None)
+def _visualizer_rllib(result_dir, checkpoints, emissions_output, horizon, video_dir, gui_config_file, tls_record_file,
+                      transition_log_dir):
     """Visualizer for RLlib experiments.
 
     This function takes arg and replays the expirement with the SUMO gui.
@@ -172,7 +187,7 @@ def _visualizer_rllib(result_dir, checkpoints, emissions_output, horizon, video_
 
     # pylint: disable=no-value-for-parameter
     agent, gym_name, config, multiagent, env_params, result_dir, sim_params = get_config(
-        result_dir, emissions_output, gui_config_file, tls_record_file)
+        result_dir, emissions_output, gui_config_file, tls_record_file, transition_log_dir)
 
     # lower the horizon if testing
     if horizon:
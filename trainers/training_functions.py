@@ -5,17 +5,29 @@ This function contains the main training functions ran by train.py
 
 import os
 from copy import deepcopy
-from rl_sumo.helpers.register_environment import make_create_env
+from rl_sumo.helpers.register_environment import make_create_env, make_create_vector_env
 
 # The frequency with which rllib checkpoints are saved 
 CHECKPOINT_FREQEUNCY = 10
 
 
+def clear_normalizer(env_params):
+    """
+    Start the observation normalization statistics from scratch, otherwise the workers merge in those of earlier runs.
+    A restored run keeps the statistics that its policy was trained with
+    """
+    from rl_sumo.environment.normalizer import clear_sync_dir
+
+    if env_params.normalize_observation and not env_params.freeze_normalizer and not env_params['restore_checkpoint']:
+        clear_sync_dir(env_params.normalizer_sync_dir)
+
+
 def run_no_rl(sim_params, env_params):
     """
     Run the environment specified in env_params without reinforcement learning.
 
-    The actions will be a random sample of the action space unless an override is desired
+    The actions will be a random sample of the action space unless an override is desired.
+    Set "transition_log_dir" in the Environment settings to log the transitions (the same goes for the RLlib workers)
 
     Args:
         sim_params
@@ -48,6 +60,8 @@ def run_no_rl(sim_params, env_params):
             if env_params['video_dir'] and not env.k.sim_time % 1 and env.k.sim_time < 300:
                 env.k.traci_c.gui.screenshot("View #0", os.path.join(env_params['video_dir'], "frame_%06d.png" % env.k.sim_time))
 
+        print(f"episode {i}: reward {sum(reward for _, reward in rewards)}")
+
         # env.reset()
 
         # save the rewards if emissions are also required
@@ -74,6 +88,51 @@ def run_no_rl(sim_params, env_params):
         print("\nGenerated emission file at " + emission_path_csv)
 
 
+def run_max_pressure(sim_params, env_params):
+    """
+    Run num_rollouts episodes of the max pressure baseline (MaxPressureController), without any policy.
+
+    The environment has to be a TLDualRingEnv. The episode rewards are printed
+
+    Args:
+        sim_params
+        env_params
+    """
+    from rl_sumo.core.actors import MaxPressureController
+    from rl_sumo.environment.dual_ring_env import TLDualRingEnv
+
+    # pylint: disable=unused-variable
+    gym_name, create_env = make_create_env(env_params, sim_params)
+
+    env = create_env()
+
+    if not isinstance(env.unwrapped, TLDualRingEnv):
+        env.close()
+        raise ValueError(
+            "max-pressure needs the TLDualRingEnv (from rl_sumo.environment.dual_ring_env) and its NEMA traffic lights, "
+            f"not {type(env.unwrapped).__name__}"
+        )
+
+    controller = MaxPressureController(env.actor, env.observer)
+
+    for i in range(env_params.num_rollouts):
+
+        env.reset()
+
+        episode_reward = 0
+        done = False
+        while not done:
+            # the pressure of the step that the environment just observed
+            pressure = env.observer.get_phase_pressure(env.k.sim_data)
+            action = controller.compute_actions(env.k.sim_time, pressure)
+            observation, reward, done, info = env.step(action)
+            episode_reward += reward
+
+        print(f"episode {i}: reward {episode_reward}")
+
+    env.close()
+
+
 def run_rllib_es(sim_params, env_params):
     """
     Run Rllib train with Evolutionary Strategies Algorithm
@@ -97,6 +156,8 @@ def run_rllib_es(sim_params, env_params):
     # start ray
     ray.init()
 
+    clear_normalizer(env_params)
+
     # force no gui, crashes computer if so many instances spawn
     sim_params.gui = False
 
@@ -170,17 +231,24 @@ def run_rllib_ppo(sim_params, env_params):
 
     ray.init()
 
+    clear_normalizer(env_params)
+
     # force no gui, crashes computer if so many instances spawn
     sim_params.gui = False
 
-    # initialize the gym
-    gym_name, create_env = make_create_env(env_params, sim_params)
+    # initialize the gym. Run several simulations per worker (in subprocesses) if requested.
+    # RLlib already creates num_envs_per_worker copies of a MultiAgentEnv itself
+    if env_params.num_envs_per_worker > 1 and not env_params.multi_agent:
+        gym_name, create_env = make_create_vector_env(env_params, sim_params)
+    else:
+        gym_name, create_env = make_create_env(env_params, sim_params)
 
     # get the agent that is desired
     agent_cls = get_agent_class(alg_run)
     config = deepcopy(agent_cls._default_config)
 
     config["num_workers"] = min(env_params.cpu_num, env_params.num_rollouts)
+    config["num_envs_per_worker"] = env_params.num_envs_per_worker
     config["train_batch_size"] = env_params.horizon * env_params.num_rollouts
     config["use_gae"] = True
     config["horizon"] = env_params.horizon
@@ -204,6 +272,24 @@ def run_rllib_ppo(sim_params, env_params):
     # save the flow params for replay
     config['env_config']['settings_input'] = env_params.json_input
 
+    if env_params.action_mask:
+        from ray.rllib.examples.models.action_mask_model import ActionMaskModel
+        from ray.rllib.models import ModelCatalog
+
+        # the model pushes the logits of the invalid actions to -inf
+        ModelCatalog.register_custom_model("action_mask", ActionMaskModel)
+        config["model"]["custom_model"] = "action_mask"
+
+    if env_params.multi_agent:
+        from ray.rllib.policy.policy import PolicySpec
+
+        # every traffic light is mapped to the same policy, so inference is batched across them.
+        # The spaces are inferred from the environment
+        config["multiagent"] = {
+            "policies": {"shared": PolicySpec()},
+            "policy_mapping_fn": lambda agent_id, *args, **kwargs: "shared",
+        }
+
     # Register as rllib env
     register_env(gym_name, create_env)
 
@@ -229,4 +315,4 @@ def run_rllib_ppo(sim_params, env_params):
 
 
 # a helper dictionary to make selecting the desired algorithm easier
-TRAINING_FUNCTIONS = {'no-rl': run_no_rl, 'es': run_rllib_es, 'ppo': run_rllib_ppo}
+TRAINING_FUNCTIONS = {'no-rl': run_no_rl, 'max-pressure': run_max_pressure, 'es': run_rllib_es, 'ppo': run_rllib_ppo}